@@ -3,11 +3,30 @@ from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import os
+import json
+import time
+import base64
 from datetime import datetime, timedelta
+import pymongo
 from pymongo import MongoClient
-import base64
+from bson.objectid import ObjectId
 import logging
+import threading
+from collections import OrderedDict
 from functools import wraps
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from blob_store import ATTACHMENT_FIELDS, get_blob_store, extract_attachments, content_base64
+from attachment_stream import attachment_response
+from ingest_spool import IngestSpool
+from db_indexes import ensure_indexes_in_background
+from email_fields import build_summary, build_recipients, build_html_text
+from html_body import build_body
+from mailbox_counters import record_received
+from recipient_map import RecipientMap
+from threads import assign_thread_id
+from limits import RateLimitItemPerMinute
+from limits.strategies import SlidingWindowCounterRateLimiter
+from rate_storage import RATELIMIT_STORAGE_URI, get_rate_limit_storage
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -36,76 +55,54 @@ def log_request_with_real_ip():
     if real_ip != request.remote_addr:
         logger.info(f"REAL_IP {real_ip} {request.method} {request.path}")
 
+# Shared rate limit storage: all gunicorn workers see the same counters
+rate_limit_storage = get_rate_limit_storage()
+
 # Initialize rate limiter with custom IP function
 limiter = Limiter(
     app=app,
     key_func=get_real_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://",
-    strategy="fixed-window"
+    storage_uri=RATELIMIT_STORAGE_URI,
+    strategy="sliding-window-counter"
 )
 
 # API Key for authentication
 API_KEY = os.getenv('API_KEY')
 
-# Brute force protection: Track failed auth attempts
-failed_attempts = {}  # {ip: {'count': int, 'blocked_until': datetime or None}}
+# Brute force protection: failed auth attempts are counted per IP in the
+# shared storage with a sliding window; blocks are TTL keys
 BLOCK_DURATION = timedelta(minutes=15)  # Block for 15 minutes
 MAX_ATTEMPTS = 5  # Maximum failed attempts
 ATTEMPT_WINDOW = timedelta(minutes=5)  # Count attempts in this window
+failed_attempts_limiter = SlidingWindowCounterRateLimiter(rate_limit_storage)
+failed_attempts_limit = RateLimitItemPerMinute(MAX_ATTEMPTS, int(ATTEMPT_WINDOW.total_seconds() // 60))
+
+def _block_key(ip):
+    return f"bruteforce/blocked/{ip}"
 
 def check_brute_force_protection(ip):
     """Check if IP is blocked due to brute force"""
-    if ip not in failed_attempts:
-        return False
-    
-    # Clean up old attempts
-    now = datetime.utcnow()
-    failed_attempts[ip]['attempts'] = [
-        attempt for attempt in failed_attempts[ip]['attempts']
-        if now - attempt < ATTEMPT_WINDOW
-    ]
-    
-    # Check if blocked
-    if failed_attempts[ip].get('blocked_until') and now < failed_attempts[ip]['blocked_until']:
-        remaining_time = (failed_attempts[ip]['blocked_until'] - now).total_seconds()
-        return remaining_time
-    
-    # Remove block if expired
-    if failed_attempts[ip].get('blocked_until') and now >= failed_attempts[ip]['blocked_until']:
-        failed_attempts[ip]['blocked_until'] = None
-        failed_attempts[ip]['count'] = 0
-    
+    if rate_limit_storage.get(_block_key(ip)) > 0:
+        remaining_time = rate_limit_storage.get_expiry(_block_key(ip)) - time.time()
+        return max(remaining_time, 1)
     return False
 
 def record_failed_attempt(ip):
     """Record a failed authentication attempt"""
-    now = datetime.utcnow()
-    if ip not in failed_attempts:
-        failed_attempts[ip] = {
-            'count': 0,
-            'attempts': [],
-            'blocked_until': None
-        }
-    
-    failed_attempts[ip]['count'] += 1
-    failed_attempts[ip]['attempts'].append(now)
-    
-    # Clean old attempts
-    failed_attempts[ip]['attempts'] = [
-        attempt for attempt in failed_attempts[ip]['attempts']
-        if now - attempt < ATTEMPT_WINDOW
-    ]
+    failed_attempts_limiter.hit(failed_attempts_limit, 'bruteforce', ip)
     
     # Check if should block
-    if failed_attempts[ip]['count'] >= MAX_ATTEMPTS:
-        failed_attempts[ip]['blocked_until'] = now + BLOCK_DURATION
+    if not failed_attempts_limiter.test(failed_attempts_limit, 'bruteforce', ip):
+        rate_limit_storage.incr(_block_key(ip), int(BLOCK_DURATION.total_seconds()))
+        failed_attempts_limiter.clear(failed_attempts_limit, 'bruteforce', ip)
         logger.warning(f"IP {ip} blocked for {BLOCK_DURATION.total_seconds()}s due to {MAX_ATTEMPTS} failed attempts")
 
 def clear_failed_attempts(ip):
     """Clear failed attempts on successful auth"""
-    if ip in failed_attempts:
-        del failed_attempts[ip]
+    # Read first so the common case (no failures) does not cost a write
+    if failed_attempts_limiter.get_window_stats(failed_attempts_limit, 'bruteforce', ip).remaining < MAX_ATTEMPTS:
+        failed_attempts_limiter.clear(failed_attempts_limit, 'bruteforce', ip)
 
 def require_api_key(f):
     """Decorator to require API key authentication with brute force protection"""
@@ -168,17 +165,173 @@ MONGO_URI = f"mongodb://{os.getenv('MONGO_USER')}:{os.getenv('MONGO_PASS')}@{os.
 client = MongoClient(MONGO_URI)
 db = client[os.getenv('MONGO_DB')]
 emails_collection = db['emails']
+attachment_store = get_blob_store(db)
+
+# Address/alias -> user ids, refreshed on user changes (see recipient_map.py)
+recipient_map = RecipientMap(db['users'], db['cache_versions'])
+
+# Build required indexes (ingest_key, keyset pagination, ...) in the background
+ensure_indexes_in_background(db)
+
+# Webhook ingest mode: 'direct' inserts inside the request, 'spool' appends to
+# a local durable spool and lets a background writer batch the inserts
+WEBHOOK_INGEST_MODE = os.getenv('WEBHOOK_INGEST_MODE', 'direct')
+# Spool mode never waits on MongoDB longer than this (seconds) to spot a retry
+SPOOL_DEDUP_TIMEOUT = float(os.getenv('SPOOL_DEDUP_TIMEOUT', '0.2'))
+
+def prepare_email_document(email_data):
+    """Turn a received ImprovMX payload into the stored email document"""
+    # Move attachment/inline bytes to the blob store, keep only references
+    extract_attachments(email_data, attachment_store)
+    
+    # Total message size (bodies + attachments) so listings never need the bodies
+    size = sum(len((email_data.get(field) or '').encode('utf-8')) for field in ('text', 'html'))
+    for field in ATTACHMENT_FIELDS:
+        size += sum(item.get('size') or 0 for item in email_data.get(field) or [] if isinstance(item, dict))
+    email_data['size'] = size
+    
+    # Precomputed list-view summary (snippet, sender, first recipient, ...)
+    email_data['summary'] = build_summary(email_data)
+    
+    # Normalized recipients (to, cc, envelope) and the users they route to
+    email_data['recipients'] = build_recipients(email_data)
+    if 'user_ids' not in email_data:
+        # Spooled before routing existed; rejection no longer applies once acknowledged
+        email_data['user_ids'] = sorted(recipient_map.route(email_data['recipients']) or [])
+    
+    # Conversation: In-Reply-To/References first, then a recent same-subject thread
+    email_data['thread_id'] = assign_thread_id(db, email_data, email_data['user_ids'])
+    
+    # Body text of HTML-only mail for the full-text search index
+    html_text = build_html_text(email_data)
+    if html_text:
+        email_data['html_text'] = html_text
+    
+    # Sanitized HTML body (cid: images rewritten) and plain text for the webmail view
+    email_data['body'] = build_body(email_data, str(email_data['_id']) if '_id' in email_data else None)
+    return email_data
+
+# Lightweight projection for list responses: header summary, sizes and
+# attachment metadata, never bodies or attachment content
+EMAIL_LIST_PROJECTION = {
+    'from': 1, 'to': 1, 'cc': 1, 'subject': 1, 'date': 1, 'message-id': 1,
+    'envelope': 1, 'received_at': 1, 'processed': 1, 'size': 1, 'summary': 1, 'thread_id': 1, 'user_ids': 1,
+    **{f'{field}.{key}': 1 for field in ATTACHMENT_FIELDS
+       for key in ('hash', 'name', 'type', 'size', 'cid')}
+}
+
+def build_fields_projection(fields):
+    """Build a projection from a comma-separated fields= parameter"""
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    if any(name.startswith('$') for name in names):
+        raise ValueError('Invalid field name')
+    projection = {name: 1 for name in names}
+    # received_at is always needed to build the next cursor
+    projection['received_at'] = 1
+    return projection
+
+# Idempotent ingest: ImprovMX retries are recognised by message-id + recipient
+RECENT_INGEST_CACHE_SIZE = int(os.getenv('RECENT_INGEST_CACHE_SIZE', '10000'))
+recent_ingest_keys = OrderedDict()  # {ingest_key: email_id}, most recent last
+recent_ingest_lock = threading.Lock()
+
+def build_ingest_key(email_data):
+    """Build the deduplication key (message-id + envelope recipient) of a payload"""
+    message_id = (email_data.get('message-id') or '').strip().lower()
+    if not message_id:
+        return None
+    
+    envelope = email_data.get('envelope') or {}
+    recipient = envelope.get('recipient') if isinstance(envelope, dict) else None
+    if not recipient:
+        # Fallback to the header recipients when there is no envelope
+        recipient = ','.join(sorted(
+            (to.get('email') or '').lower() for to in email_data.get('to', []) if isinstance(to, dict)
+        ))
+    return f"{message_id}|{recipient.strip().lower()}"
+
+def remember_ingest_key(ingest_key, email_id):
+    """Record an ingested key in the bounded recent-IDs cache"""
+    with recent_ingest_lock:
+        recent_ingest_keys[ingest_key] = str(email_id)
+        recent_ingest_keys.move_to_end(ingest_key)
+        while len(recent_ingest_keys) > RECENT_INGEST_CACHE_SIZE:
+            recent_ingest_keys.popitem(last=False)
+
+def find_ingested_email_id(ingest_key):
+    """Return the email_id already stored for an ingest key, or None"""
+    with recent_ingest_lock:
+        email_id = recent_ingest_keys.get(ingest_key)
+    if email_id:
+        return email_id
+    
+    existing = emails_collection.find_one({'ingest_key': ingest_key}, {'_id': 1})
+    if existing:
+        remember_ingest_key(ingest_key, existing['_id'])
+        return str(existing['_id'])
+    return None
+
+def find_spooled_duplicate(ingest_key):
+    """
+    Spool mode: find_ingested_email_id bounded by SPOOL_DEDUP_TIMEOUT, so a slow
+    or unreachable MongoDB never blocks the webhook. On errors the payload is
+    spooled anyway; the unique ingest_key index drops the copy at flush time
+    """
+    try:
+        # Bounds server selection too, and sends the remaining time as maxTimeMS
+        with pymongo.timeout(SPOOL_DEDUP_TIMEOUT):
+            return find_ingested_email_id(ingest_key)
+    except PyMongoError as e:
+        logger.warning(f"Skipping duplicate lookup, MongoDB unavailable: {str(e)}")
+        return None
+
+def duplicate_email_response(email_id):
+    """Response for a retried delivery that was already stored"""
+    logger.info(f"Duplicate delivery ignored, original email ID: {email_id}")
+    return jsonify({
+        'success': True,
+        'message': 'Email already received',
+        'email_id': email_id
+    }), 200
+
+ingest_spool = None
+if WEBHOOK_INGEST_MODE == 'spool':
+    ingest_spool = IngestSpool(
+        emails_collection,
+        prepare=prepare_email_document,
+        on_insert=lambda documents: record_received(db, documents)
+    )
+    ingest_spool.start()
+    logger.info(f"Webhook ingest spool enabled: {ingest_spool.path}")
+
+def encode_cursor(email):
+    """Encode the (received_at, _id) position of an email as an opaque cursor"""
+    position = {'r': email['received_at'].isoformat(), 'i': str(email['_id'])}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a cursor into (received_at, _id); raises ValueError if malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(position['r']), ObjectId(position['i'])
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {str(e)}")
 
 @app.route('/', methods=['GET'])
 @require_api_key
 @limiter.limit("30 per minute")  # Health check can be called frequently
 def health_check():
     """Health check endpoint"""
-    return jsonify({
+    health = {
         'status': 'healthy',
         'service': 'ImprovMX Webhook',
         'timestamp': datetime.utcnow().isoformat()
-    }), 200
+    }
+    if ingest_spool:
+        health['spool'] = ingest_spool.stats()
+    health['recipient_map'] = recipient_map.stats()
+    return jsonify(health), 200
 
 @app.route('/docs', methods=['GET'])
 @limiter.limit("60 per minute")  # Docs can be accessed frequently
@@ -219,12 +372,59 @@ def receive_email():
         logger.info(f"Received email from {email_data.get('from', {}).get('email', 'unknown')}")
         logger.info(f"Subject: {email_data.get('subject', 'No subject')}")
         
+        # Route to our users from the in-memory map; unknown recipients follow the policy
+        recipients = build_recipients(email_data)
+        user_ids = recipient_map.route(recipients)
+        if user_ids is None:
+            logger.info(f"Email rejected, no mailbox for {', '.join(recipients) or 'unknown'}")
+            # 200 so ImprovMX does not retry a delivery we will never accept
+            return jsonify({
+                'success': False,
+                'message': 'No mailbox for recipient, email rejected'
+            }), 200
+        email_data['user_ids'] = sorted(user_ids)
+        
+        # Short-circuit ImprovMX retries of an email we already have
+        ingest_key = build_ingest_key(email_data)
+        if ingest_key:
+            existing_id = find_spooled_duplicate(ingest_key) if ingest_spool else find_ingested_email_id(ingest_key)
+            if existing_id:
+                return duplicate_email_response(existing_id)
+            email_data['ingest_key'] = ingest_key
+        
         # Add metadata
+        email_data['_id'] = ObjectId()
         email_data['received_at'] = datetime.utcnow()
         email_data['processed'] = False
+        # Cleared by record_received once the mail is in its recipients' mailboxes
+        email_data['entries_pending'] = True
+        
+        # Spool mode: durably queue the payload and answer immediately
+        if ingest_spool:
+            ingest_spool.append(email_data)
+            if ingest_key:
+                remember_ingest_key(ingest_key, email_data['_id'])
+            logger.info(f"Email spooled with ID: {email_data['_id']}")
+            return jsonify({
+                'success': True,
+                'message': 'Email received and queued',
+                'email_id': str(email_data['_id'])
+            }), 200
+        
+        # Insert into MongoDB (the unique ingest_key index catches concurrent retries)
+        try:
+            result = emails_collection.insert_one(prepare_email_document(email_data))
+        except DuplicateKeyError:
+            existing_id = find_ingested_email_id(ingest_key) if ingest_key else None
+            if not existing_id:
+                raise
+            return duplicate_email_response(existing_id)
         
-        # Insert into MongoDB
-        result = emails_collection.insert_one(email_data)
+        # Per-user inbox and unread counters
+        record_received(db, [email_data])
+        
+        if ingest_key:
+            remember_ingest_key(ingest_key, result.inserted_id)
         
         logger.info(f"Email saved to MongoDB with ID: {result.inserted_id}")
         
@@ -250,15 +450,30 @@ def get_emails():
     Retrieve stored emails from MongoDB
     Query parameters:
     - limit: number of emails to return (default: 10)
-    - skip: number of emails to skip (default: 0)
+    - cursor: opaque cursor from a previous response's next_cursor
+    - skip: number of emails to skip (default: 0, ignored when cursor is given)
     - from_email: filter by sender email
     - subject: filter by subject (partial match)
+    - fields: comma-separated fields to return (default: list summary)
     """
     try:
         limit = int(request.args.get('limit', 10))
         skip = int(request.args.get('skip', 0))
+        cursor = request.args.get('cursor')
         from_email = request.args.get('from_email')
         subject = request.args.get('subject')
+        fields = request.args.get('fields')
+        
+        # Only ship what the caller asked for (summary by default)
+        projection = EMAIL_LIST_PROJECTION
+        if fields:
+            try:
+                projection = build_fields_projection(fields)
+            except ValueError as e:
+                return jsonify({
+                    'success': False,
+                    'error': str(e)
+                }), 400
         
         # Build query
         query = {}
@@ -267,8 +482,32 @@ def get_emails():
         if subject:
             query['subject'] = {'$regex': subject, '$options': 'i'}
         
-        # Fetch emails
-        emails = list(emails_collection.find(query).sort('received_at', -1).skip(skip).limit(limit))
+        # Keyset pagination: continue strictly after the cursor position
+        if cursor:
+            try:
+                received_at, last_id = decode_cursor(cursor)
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'error': 'Invalid cursor'
+                }), 400
+            query = {'$and': [query, {'$or': [
+                {'received_at': {'$lt': received_at}},
+                {'received_at': received_at, '_id': {'$lt': last_id}}
+            ]}]}
+            skip = 0
+        
+        # Fetch one extra email to know whether there is a next page
+        emails = list(emails_collection
+                      .find(query, projection)
+                      .sort([('received_at', -1), ('_id', -1)])
+                      .skip(skip)
+                      .limit(limit + 1))
+        
+        next_cursor = None
+        if len(emails) > limit:
+            emails = emails[:limit]
+            next_cursor = encode_cursor(emails[-1])
         
         # Convert ObjectId to string and format datetime
         for email in emails:
@@ -279,7 +518,8 @@ def get_emails():
         return jsonify({
             'success': True,
             'count': len(emails),
-            'emails': emails
+            'emails': emails,
+            'next_cursor': next_cursor
         }), 200
         
     except Exception as e:
@@ -295,10 +535,17 @@ def get_emails():
 def get_email(email_id):
     """
     Retrieve a specific email by ID
+    Query parameters:
+    - include: 'attachments' to embed base64 attachment/inline content
     """
     try:
         from bson.objectid import ObjectId
-        email = emails_collection.find_one({'_id': ObjectId(email_id)})
+        include = [part.strip() for part in request.args.get('include', '').split(',')]
+        include_attachments = 'attachments' in include
+        
+        # Legacy documents may still embed base64 content; skip it unless asked
+        projection = None if include_attachments else {f'{field}.content': 0 for field in ATTACHMENT_FIELDS}
+        email = emails_collection.find_one({'_id': ObjectId(email_id)}, projection)
         
         if not email:
             return jsonify({
@@ -306,6 +553,11 @@ def get_email(email_id):
                 'error': 'Email not found'
             }), 404
         
+        if include_attachments:
+            for field in ATTACHMENT_FIELDS:
+                for item in email.get(field) or []:
+                    item['content'] = content_base64(item, attachment_store)
+        
         email['_id'] = str(email['_id'])
         if 'received_at' in email:
             email['received_at'] = email['received_at'].isoformat()
@@ -328,10 +580,18 @@ def get_email(email_id):
 def get_attachment(email_id, attachment_name):
     """
     Retrieve a specific attachment from an email
+    Supports Range requests and conditional requests (ETag / If-None-Match)
     """
     try:
         from bson.objectid import ObjectId
-        email = emails_collection.find_one({'_id': ObjectId(email_id)})
+        # Only fetch the matching attachment/inline, not the whole email
+        email = emails_collection.find_one(
+            {'_id': ObjectId(email_id)},
+            {
+                'attachments': {'$elemMatch': {'name': attachment_name}},
+                'inlines': {'$elemMatch': {'name': attachment_name}}
+            }
+        )
         
         if not email:
             return jsonify({'error': 'Email not found'}), 404
@@ -339,24 +599,12 @@ def get_attachment(email_id, attachment_name):
         # Search in attachments
         for attachment in email.get('attachments', []):
             if attachment['name'] == attachment_name:
-                content = base64.b64decode(attachment['content'])
-                from flask import Response
-                return Response(
-                    content,
-                    mimetype=attachment['type'],
-                    headers={'Content-Disposition': f'attachment; filename="{attachment_name}"'}
-                )
+                return attachment_response(attachment, attachment_store, disposition='attachment')
         
         # Search in inlines
         for inline in email.get('inlines', []):
             if inline['name'] == attachment_name:
-                content = base64.b64decode(inline['content'])
-                from flask import Response
-                return Response(
-                    content,
-                    mimetype=inline['type'],
-                    headers={'Content-Disposition': f'inline; filename="{attachment_name}"'}
-                )
+                return attachment_response(inline, attachment_store, disposition='inline')
         
         return jsonify({'error': 'Attachment not found'}), 404
         
@@ -0,0 +1,139 @@
+"""
+Streaming attachment responses
+Serves attachments from the blob store (or legacy base64 content) in
+constant memory, with HTTP Range/206 support, a strong ETag derived from
+the content hash and If-None-Match/If-Range handling.
+"""
+
+import base64
+import binascii
+import hashlib
+from urllib.parse import quote
+
+from flask import Response, request
+
+from blob_store import BlobNotFound
+
+CHUNK_SIZE = 64 * 1024  # Bytes per streamed chunk
+
+
+class Base64Reader:
+    """Seekable file-like object that decodes a base64 string lazily"""
+
+    def __init__(self, encoded):
+        if any(c in encoded for c in ' \r\n\t'):
+            encoded = ''.join(encoded.split())
+        self.encoded = encoded
+        padding = encoded[-2:].count('=') if encoded else 0
+        self.length = len(encoded) // 4 * 3 - padding
+        self.position = 0
+
+    def seek(self, position):
+        self.position = max(0, min(position, self.length))
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length - self.position
+        end = min(self.position + size, self.length)
+        if end <= self.position:
+            return b''
+
+        # Decode only the aligned 4-character groups covering [position, end)
+        first_group = self.position // 3
+        last_group = (end + 2) // 3
+        try:
+            decoded = base64.b64decode(self.encoded[first_group * 4:last_group * 4])
+        except binascii.Error as e:
+            raise ValueError(f"Invalid base64 attachment content: {str(e)}")
+        offset = self.position - first_group * 3
+        data = decoded[offset:offset + (end - self.position)]
+        self.position = end
+        return data
+
+    def close(self):
+        pass
+
+
+def open_attachment(item, store):
+    """Return (file object, size, etag) for an attachment reference or legacy item"""
+    if item.get('hash'):
+        blob = store.open(item['hash'])
+        size = item.get('size')
+        if size is None:
+            size = getattr(blob, 'length', None)
+            if size is None:
+                blob.seek(0, 2)
+                size = blob.tell()
+                blob.seek(0)
+        return blob, size, item['hash']
+
+    content = item.get('content') or ''
+    reader = Base64Reader(content)
+    return reader, reader.length, hashlib.sha256(content.encode('ascii', 'ignore')).hexdigest()
+
+
+def _stream(blob, start, length):
+    """Yield length bytes from blob starting at start, in CHUNK_SIZE chunks"""
+    try:
+        blob.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = blob.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        blob.close()
+
+
+def content_disposition(disposition, filename):
+    """Content-Disposition header value with an RFC 5987 UTF-8 filename"""
+    filename = filename or 'attachment'
+    fallback = filename.encode('ascii', 'replace').decode('ascii').replace('"', '')
+    return f"{disposition}; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def attachment_response(item, store, disposition='attachment', cache_control=None):
+    """Build a streaming (optionally partial or 304) response for an attachment"""
+    try:
+        blob, size, digest = open_attachment(item, store)
+    except BlobNotFound:
+        return Response('Attachment content not found', status=404, mimetype='text/plain')
+
+    headers = {
+        'ETag': f'"{digest}"',
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': content_disposition(disposition, item.get('name'))
+    }
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    mimetype = item.get('type') or 'application/octet-stream'
+
+    # Repeat download of unchanged content
+    if request.if_none_match and request.if_none_match.contains(digest):
+        blob.close()
+        return Response(status=304, headers=headers)
+
+    start, end, status = 0, size, 200
+    if request.range and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+        # If-Range: only honour the range when the client's copy is current
+        if_range = request.if_range
+        if (if_range.etag is None and if_range.date is None) or if_range.etag == digest:
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                blob.close()
+                headers['Content-Range'] = f'bytes */{size}'
+                return Response(status=416, headers=headers)
+            start, end = byte_range
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+
+    headers['Content-Length'] = str(end - start)
+    return Response(
+        _stream(blob, start, end - start),
+        status=status,
+        mimetype=mimetype,
+        headers=headers,
+        direct_passthrough=True
+    )
@@ -0,0 +1,339 @@
+"""
+Content-addressed attachment store for ImprovMX emails
+Attachment and inline bytes are stored once, keyed by their SHA-256 hash,
+either in GridFS or in a local directory. Email documents only keep small
+references: {hash, name, type, size, cid}.
+
+Deleting a message leaves its blobs in place (other messages may share them);
+blobs no message references any more are removed by the periodic sweep run by
+`python mailbox_counters.py reconcile`. Storing content that already exists
+marks the blob as used, so the sweep never removes a blob a new message is
+about to reference.
+"""
+
+import os
+import base64
+import hashlib
+import logging
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import gridfs
+from gridfs.errors import FileExists, NoFile
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Backend selection: 'gridfs' (default) or 'local'
+ATTACHMENT_STORE = os.getenv('ATTACHMENT_STORE', 'gridfs')
+ATTACHMENT_STORE_PATH = os.getenv('ATTACHMENT_STORE_PATH', 'attachments')
+GRIDFS_BUCKET = 'attachments'
+
+# Email document fields that carry base64 content from ImprovMX
+ATTACHMENT_FIELDS = ('attachments', 'inlines')
+
+COPY_CHUNK_SIZE = 1024 * 1024  # Bytes per read when storing a stream
+
+# GridFS chunks without a files document are only removed once their newest
+# chunk is this old (seconds): until then an upload may still be writing them
+GRIDFS_ORPHAN_GRACE = float(os.getenv('GRIDFS_ORPHAN_GRACE', '60'))
+GRIDFS_UPLOAD_WAIT = 2.0  # Seconds to wait for a concurrent upload of the same blob
+
+# Unreferenced blobs used within this many seconds are kept by the sweep
+# (their message may still be spooled, queued or being composed)
+BLOB_SWEEP_GRACE = float(os.getenv('BLOB_SWEEP_GRACE', str(24 * 3600)))
+
+# Collections and fields holding blob references
+BLOB_REFERENCES = {
+    'emails': ATTACHMENT_FIELDS,
+    'sent_emails': ('attachments',),
+    'draft_emails': ('attachments',),
+}
+
+
+class BlobNotFound(Exception):
+    """Raised when a referenced blob is missing from the store"""
+
+
+def _copy_hashing(stream, target):
+    """Copy stream into target in chunks; returns (sha256 hex digest, size)"""
+    sha256 = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        sha256.update(chunk)
+        target.write(chunk)
+        size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+class GridFSBlobStore:
+    """Blob store backed by a GridFS bucket, using the hash as file _id"""
+
+    def __init__(self, db, bucket_name=GRIDFS_BUCKET):
+        self.bucket = gridfs.GridFSBucket(db, bucket_name=bucket_name)
+        self.files = db[f'{bucket_name}.files']
+        self.chunks = db[f'{bucket_name}.chunks']
+
+    def exists(self, digest):
+        return self.files.count_documents({'_id': digest}, limit=1) > 0
+
+    def _touch(self, digest):
+        """Mark a stored blob as used now; False if it does not exist"""
+        result = self.files.update_one({'_id': digest}, {'$set': {'metadata.used_at': datetime.utcnow()}})
+        return result.matched_count > 0
+
+    def _upload(self, digest, source):
+        """Upload source (bytes or a seekable file) under digest unless it is already stored"""
+        for attempt in range(2):
+            if hasattr(source, 'seek'):
+                source.seek(0)
+            try:
+                self.bucket.upload_from_stream_with_id(digest, digest, source)
+                return
+            except (FileExists, DuplicateKeyError):
+                # Usually another worker is storing the same content
+                if self._wait_for(digest):
+                    return
+                if attempt or not self._remove_orphaned_chunks(digest):
+                    raise
+
+    def _wait_for(self, digest):
+        """Whether the blob gets its files document within GRIDFS_UPLOAD_WAIT seconds"""
+        deadline = time.monotonic() + GRIDFS_UPLOAD_WAIT
+        while not self.exists(digest):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _remove_orphaned_chunks(self, digest):
+        """
+        Delete the chunks of an upload that died before writing its files
+        document; False when a chunk was written within GRIDFS_ORPHAN_GRACE,
+        as that upload may still be running
+        """
+        newest = self.chunks.find_one({'files_id': digest}, {'_id': 1}, sort=[('_id', -1)])
+        if newest is not None:
+            age = datetime.now(timezone.utc) - newest['_id'].generation_time
+            if age < timedelta(seconds=GRIDFS_ORPHAN_GRACE):
+                return False
+            logger.warning(f"Removing orphaned GridFS chunks of blob {digest}")
+            self.chunks.delete_many({'files_id': digest})
+        return True
+
+    def unused_blobs(self, cutoff):
+        """Digests of blobs neither uploaded nor reused since cutoff (naive UTC)"""
+        for blob in self.files.find(self._unused_query(cutoff), {'_id': 1}):
+            yield blob['_id']
+
+    def delete_unused(self, digest, cutoff):
+        """Delete a blob unless it was used since cutoff; returns whether it was deleted"""
+        if not self.files.delete_one({'_id': digest, **self._unused_query(cutoff)}).deleted_count:
+            return False
+        self.chunks.delete_many({'files_id': digest})
+        return True
+
+    @staticmethod
+    def _unused_query(cutoff):
+        return {'uploadDate': {'$lt': cutoff},
+                '$or': [{'metadata.used_at': {'$exists': False}}, {'metadata.used_at': {'$lt': cutoff}}]}
+
+    def put(self, data):
+        """Store bytes and return their SHA-256 hex digest (deduplicated)"""
+        digest = hashlib.sha256(data).hexdigest()
+        if not self._touch(digest):
+            self._upload(digest, data)
+        return digest
+
+    def put_stream(self, stream):
+        """Store a file-like object in constant memory; returns (digest, size)"""
+        # The hash is the file _id, so spool to a temp file before uploading
+        with tempfile.TemporaryFile() as tmp:
+            digest, size = _copy_hashing(stream, tmp)
+            if not self._touch(digest):
+                self._upload(digest, tmp)
+        return digest, size
+
+    def open(self, digest):
+        """Return a readable, seekable file object for a blob"""
+        try:
+            return self.bucket.open_download_stream(digest)
+        except NoFile:
+            raise BlobNotFound(digest)
+
+    def get(self, digest):
+        with self.open(digest) as blob:
+            return blob.read()
+
+
+class LocalBlobStore:
+    """Blob store backed by a local directory (ab/cd/<hash> layout)"""
+
+    def __init__(self, root=ATTACHMENT_STORE_PATH):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self._path(digest))
+
+    def _touch(self, digest):
+        """Mark a stored blob as used now (its mtime); False if it does not exist"""
+        try:
+            os.utime(self._path(digest))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def unused_blobs(self, cutoff):
+        """Digests of blobs neither written nor reused since cutoff (naive UTC)"""
+        cutoff = cutoff.replace(tzinfo=timezone.utc).timestamp()
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if not name.startswith('.tmp-') and os.path.getmtime(os.path.join(directory, name)) < cutoff:
+                    yield name
+
+    def delete_unused(self, digest, cutoff):
+        """Delete a blob unless it was used since cutoff; returns whether it was deleted"""
+        path = self._path(digest)
+        try:
+            if os.path.getmtime(path) >= cutoff.replace(tzinfo=timezone.utc).timestamp():
+                return False
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put(self, data):
+        """Store bytes and return their SHA-256 hex digest (deduplicated)"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not self._touch(digest):
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # Write to a temp file and rename so readers never see partial blobs
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as tmp:
+                    tmp.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+        return digest
+
+    def put_stream(self, stream):
+        """Store a file-like object in constant memory; returns (digest, size)"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                digest, size = _copy_hashing(stream, tmp)
+            path = self._path(digest)
+            if self._touch(digest):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return digest, size
+
+    def open(self, digest):
+        """Return a readable, seekable file object for a blob"""
+        try:
+            return open(self._path(digest), 'rb')
+        except FileNotFoundError:
+            raise BlobNotFound(digest)
+
+    def get(self, digest):
+        with self.open(digest) as blob:
+            return blob.read()
+
+
+def get_blob_store(db):
+    """Create the blob store configured by ATTACHMENT_STORE"""
+    if ATTACHMENT_STORE == 'local':
+        return LocalBlobStore(ATTACHMENT_STORE_PATH)
+    return GridFSBlobStore(db)
+
+
+def referenced_blobs(db):
+    """Set of the digests referenced by any stored, sent or draft message"""
+    referenced = set()
+    for collection_name, fields in BLOB_REFERENCES.items():
+        for field in fields:
+            for group in db[collection_name].aggregate([
+                {'$match': {f'{field}.hash': {'$exists': True}}},
+                {'$unwind': f'${field}'},
+                {'$group': {'_id': f'${field}.hash'}}
+            ], allowDiskUse=True):
+                if group['_id']:
+                    referenced.add(group['_id'])
+    return referenced
+
+
+def sweep_blobs(db, store, grace=BLOB_SWEEP_GRACE):
+    """
+    Delete blobs no message references and nothing used within grace seconds;
+    returns how many were deleted. Candidates are listed before the references
+    are read, and a blob reused meanwhile is skipped by delete_unused
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    candidates = list(store.unused_blobs(cutoff))
+    if not candidates:
+        return 0
+    referenced = referenced_blobs(db)
+    return sum(1 for digest in candidates if digest not in referenced and store.delete_unused(digest, cutoff))
+
+
+def extract_attachments(email_data, store):
+    """
+    Move base64 attachment/inline content into the blob store.
+    Replaces each item in email_data with a {hash, name, type, size, cid}
+    reference. Items that are already references are left untouched.
+    """
+    for field in ATTACHMENT_FIELDS:
+        items = email_data.get(field)
+        if not items:
+            continue
+
+        references = []
+        for item in items:
+            if not isinstance(item, dict) or 'content' not in item:
+                references.append(item)
+                continue
+
+            data = base64.b64decode(item.get('content') or '')
+            references.append({
+                'hash': store.put(data),
+                'name': item.get('name'),
+                'type': item.get('type', 'application/octet-stream'),
+                'size': len(data),
+                'cid': item.get('cid')
+            })
+        email_data[field] = references
+
+    return email_data
+
+
+def read_content(item, store):
+    """Return the raw bytes of an attachment reference (or legacy base64 item)"""
+    if item.get('hash'):
+        return store.get(item['hash'])
+    return base64.b64decode(item.get('content') or '')
+
+
+def content_base64(item, store):
+    """Return the base64 content of an attachment reference (or legacy item)"""
+    if item.get('hash'):
+        return base64.b64encode(store.get(item['hash'])).decode('ascii')
+    return item.get('content') or ''
@@ -0,0 +1,176 @@
+"""
+Index management for the ImprovMX webhook and webmail collections
+Declares the indexes both applications rely on, builds them in the
+background at startup and reports missing, unused or obsolete indexes.
+
+Usage:
+    python db_indexes.py ensure   # Create any missing index
+    python db_indexes.py check    # Report missing, unused and obsolete indexes
+"""
+
+import os
+import sys
+import json
+import logging
+import threading
+
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Text indexes: mail mixes Spanish and English, so no language-specific
+# stemming or stop words; matching is case- and diacritic-insensitive.
+# language_override points at a field we never store, so a stray 'language'
+# key in a webhook payload cannot break inserts
+TEXT_INDEX_OPTIONS = {'default_language': 'none', 'language_override': 'search_language'}
+
+# Required indexes per collection: (name, keys, options)
+REQUIRED_INDEXES = {
+    'emails': [
+        # Idempotent webhook ingest (message-id + envelope recipient)
+        ('ingest_key_unique', [('ingest_key', 1)],
+         {'unique': True, 'partialFilterExpression': {'ingest_key': {'$type': 'string'}}}),
+        # API listing and keyset pagination
+        ('received_at_id', [('received_at', -1), ('_id', -1)], {}),
+        # Mail routed to a user at ingest (multikey): access checks and searches
+        ('user_ids_received_at', [('user_ids', 1), ('received_at', -1)], {}),
+        # Threading: parent lookup by message-id, messages of a thread
+        ('message_id', [('message-id', 1)], {}),
+        ('thread_id_received_at', [('thread_id', 1), ('received_at', -1)], {}),
+        # Emails whose mailbox fan-out failed at ingest (mailbox_counters.py reconcile)
+        ('entries_pending', [('entries_pending', 1)], {'partialFilterExpression': {'entries_pending': True}}),
+        # Webmail full-text search (html_text holds the body of HTML-only mail)
+        ('search_text', [('subject', 'text'), ('from.name', 'text'), ('from.email', 'text'),
+                         ('recipients', 'text'), ('text', 'text'), ('html_text', 'text')],
+         {**TEXT_INDEX_OPTIONS,
+          'weights': {'subject': 10, 'from.name': 5, 'from.email': 5, 'recipients': 3}}),
+    ],
+    'sent_emails': [
+        ('user_id_sent_at', [('user_id', 1), ('sent_at', -1)], {}),
+        # Outbound queue: due messages (webmail/outbound_worker.py)
+        ('status_next_attempt_at', [('status', 1), ('next_attempt_at', 1)], {}),
+        # Per-user full-text search (equality prefix on user_id)
+        ('user_id_search_text', [('user_id', 1), ('subject', 'text'), ('to', 'text'),
+                                 ('cc', 'text'), ('message', 'text')],
+         {**TEXT_INDEX_OPTIONS, 'weights': {'subject': 10, 'to': 3, 'cc': 3}}),
+    ],
+    'draft_emails': [
+        ('user_id_updated_at', [('user_id', 1), ('updated_at', -1)], {}),
+        ('user_id_search_text', [('user_id', 1), ('subject', 'text'), ('to', 'text'),
+                                 ('cc', 'text'), ('message', 'text')],
+         {**TEXT_INDEX_OPTIONS, 'weights': {'subject': 10, 'to': 3, 'cc': 3}}),
+    ],
+    'mailbox_entries': [
+        # Per-user inbox and trash listings, newest first
+        ('user_id_trashed_received_at', [('user_id', 1), ('flags.trashed', 1), ('received_at', -1)], {}),
+        # Unread folder and counts: only unseen entries outside the trash are indexed
+        ('user_id_unread_received_at', [('user_id', 1), ('received_at', -1)],
+         {'partialFilterExpression': {'flags.seen': False, 'flags.trashed': False}}),
+        # Messages of a conversation in the user's mailbox
+        ('user_id_thread_id_received_at', [('user_id', 1), ('thread_id', 1), ('received_at', 1)], {}),
+        # Entries of an email (global delete, thread backfill)
+        ('email_id', [('email_id', 1)], {}),
+    ],
+    'threads': [
+        # Threaded inbox, newest conversation first
+        ('user_id_last_date', [('user_id', 1), ('last_date', -1)], {}),
+        # Subject fallback for messages without references
+        ('user_id_subject_key_last_date', [('user_id', 1), ('subject_key', 1), ('last_date', -1)], {}),
+    ],
+    'users': [
+        ('email_unique', [('email', 1)], {'unique': True}),
+        ('aliases', [('aliases', 1)], {}),
+    ],
+}
+
+# Indexes older versions created that no query uses any more; drop them by hand
+OBSOLETE_INDEXES = {
+    # Mailbox queries by recipient, replaced by user_ids_received_at
+    'emails': ['recipients_received_at'],
+}
+
+
+def ensure_indexes(db):
+    """Create every required index that does not exist yet"""
+    created = []
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        collection = db[collection_name]
+        for name, keys, options in indexes:
+            try:
+                collection.create_index(keys, name=name, background=True, **options)
+                created.append(f"{collection_name}.{name}")
+            except OperationFailure as e:
+                # Usually an equivalent index with another name/options exists
+                logger.warning(f"Could not create index {collection_name}.{name}: {str(e)}")
+    return created
+
+
+def ensure_indexes_in_background(db):
+    """Build required indexes without delaying application startup"""
+    def build():
+        try:
+            ensure_indexes(db)
+            logger.info("Index bootstrap completed")
+        except Exception as e:
+            logger.error(f"Index bootstrap failed: {str(e)}")
+
+    thread = threading.Thread(target=build, name='index-bootstrap', daemon=True)
+    thread.start()
+    return thread
+
+
+def check_index_health(db):
+    """
+    Report required indexes that are missing, existing indexes that have
+    not been used since the server started ($indexStats) and obsolete
+    indexes that are still present
+    """
+    report = {}
+    for collection_name, indexes in REQUIRED_INDEXES.items():
+        collection = db[collection_name]
+        existing = collection.index_information()
+        existing_keys = [[tuple(key) for key in info['key']] for info in existing.values()]
+        # Text indexes are stored as _fts/_ftsx keys, so also match by name
+        missing = [name for name, keys, _ in indexes if name not in existing and keys not in existing_keys]
+
+        unused = []
+        try:
+            for stats in collection.aggregate([{'$indexStats': {}}]):
+                if stats['name'] != '_id_' and stats.get('accesses', {}).get('ops', 0) == 0:
+                    unused.append(stats['name'])
+        except OperationFailure as e:
+            logger.warning(f"Could not read index stats for {collection_name}: {str(e)}")
+
+        report[collection_name] = {
+            'existing': sorted(existing),
+            'missing': missing,
+            'unused': sorted(unused),
+            'obsolete': [name for name in OBSOLETE_INDEXES.get(collection_name, []) if name in existing]
+        }
+    return report
+
+
+def get_database():
+    """Connect using the same environment variables as the applications"""
+    mongo_uri = f"mongodb://{os.getenv('MONGO_USER', 'Admin')}:{os.getenv('MONGO_PASS', '')}@{os.getenv('MONGO_HOST', 'localhost')}"
+    client = MongoClient(mongo_uri)
+    return client[os.getenv('MONGO_DB', 'webmail_improvmx')]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    database = get_database()
+
+    if command == 'ensure':
+        for index in ensure_indexes(database):
+            print(f"✓ {index}")
+    elif command == 'check':
+        health = check_index_health(database)
+        print(json.dumps(health, indent=2))
+        if any(collection['missing'] for collection in health.values()):
+            sys.exit(1)
+    else:
+        print(f"Usage: python {sys.argv[0]} [ensure|check]")
+        sys.exit(2)
@@ -0,0 +1,131 @@
+"""
+Derived email fields computed once at ingest
+Shared by the webhook (ingest) and migrations.py (backfill of existing mail)
+so list views never need to parse bodies per request.
+"""
+
+import re
+from html import unescape
+from html.parser import HTMLParser
+
+SNIPPET_LENGTH = 150
+
+# Fields a summary is built from (projection for backfills and fallbacks)
+SUMMARY_SOURCE_FIELDS = {
+    'from': 1, 'to': 1, 'envelope': 1, 'subject': 1, 'text': 1, 'html': 1, 'attachments.name': 1
+}
+
+# Fields the recipients array is built from
+RECIPIENT_SOURCE_FIELDS = {'to': 1, 'cc': 1, 'envelope': 1}
+
+# Fields the searchable body text is built from
+SEARCH_SOURCE_FIELDS = {'text': 1, 'html': 1}
+
+
+class _TextExtractor(HTMLParser):
+    """Collect visible text from HTML, skipping script/style/head content"""
+
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+    BLOCK_TAGS = {'br', 'p', 'div', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'blockquote'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    """Extract readable plain text from an HTML body"""
+    if not html:
+        return ''
+    extractor = _TextExtractor()
+    try:
+        extractor.feed(html)
+        extractor.close()
+        text = ''.join(extractor.parts)
+    except Exception:
+        # Badly broken markup: fall back to stripping tags
+        text = unescape(re.sub(r'<[^>]+>', ' ', html))
+    # Collapse runs of spaces but keep line breaks
+    text = re.sub(r'[ \t\r\f\v\xa0]+', ' ', text)
+    return re.sub(r'\s*\n\s*', '\n', text).strip()
+
+
+def build_summary(email):
+    """Compact list-view summary of a received email"""
+    # Get actual recipient from email's 'to' field
+    to_list = email.get('to') or []
+    if to_list:
+        first_recipient = to_list[0]
+        to_email = first_recipient.get('email', '') if isinstance(first_recipient, dict) else str(first_recipient)
+    else:
+        # Fallback to envelope recipient if no 'to' field
+        envelope = email.get('envelope') or {}
+        to_email = envelope.get('recipient', '') if isinstance(envelope, dict) else ''
+
+    # Get 'from' field safely
+    from_field = email.get('from') or {}
+    if isinstance(from_field, dict):
+        from_name = from_field.get('name') or ''
+        from_email = from_field.get('email') or ''
+    else:
+        from_name = ''
+        from_email = str(from_field)
+
+    # Snippet from the text body, or from the HTML body when there is no text
+    body = email.get('text') or html_to_text(email.get('html'))
+    body = ' '.join(body.split())
+    snippet = (body[:SNIPPET_LENGTH] + '...') if body else ''
+
+    return {
+        'subject': email.get('subject') or '(No subject)',
+        'from_name': from_name,
+        'from_email': from_email,
+        'to_email': to_email or 'No recipient',
+        'has_attachments': len(email.get('attachments') or []) > 0,
+        'snippet': snippet
+    }
+
+
+def build_recipients(email):
+    """Lowercased, de-duplicated addresses from to, cc and the envelope recipient"""
+    addresses = []
+    for field in ('to', 'cc'):
+        for recipient in email.get(field) or []:
+            address = recipient.get('email') if isinstance(recipient, dict) else recipient
+            if address:
+                addresses.append(str(address))
+
+    envelope = email.get('envelope') or {}
+    if isinstance(envelope, dict) and envelope.get('recipient'):
+        addresses.append(str(envelope['recipient']))
+
+    recipients = []
+    for address in addresses:
+        address = address.strip().lower()
+        if address and address not in recipients:
+            recipients.append(address)
+    return recipients
+
+
+def build_html_text(email):
+    """Plain text of an HTML-only email, so the text index covers its body"""
+    if email.get('text'):
+        return None
+    return html_to_text(email.get('html')) or None
@@ -0,0 +1,153 @@
+"""
+Processed message bodies
+Turns the raw HTML of a message into sanitized HTML (allow-listed tags and
+attributes, no scripts or event handlers, cid: images pointing at the
+webmail inline endpoint) plus plain text, once, so the message view is a
+straight read. Stored as the `body` field with BODY_VERSION; bodies with an
+older version are rebuilt lazily on view or by `migrations.py backfill-body`.
+"""
+
+import re
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import quote
+
+from email_fields import html_to_text
+
+# Bump whenever sanitizing or rewriting rules change
+BODY_VERSION = 1
+
+# Webmail route serving inline images (see webmail/app.py inline_image)
+INLINE_URL_TEMPLATE = '/inline/{email_id}/{cid}'
+
+# Fields a body is built from
+BODY_SOURCE_FIELDS = {'text': 1, 'html': 1, 'message': 1, 'inlines.cid': 1}
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'address', 'b', 'big', 'blockquote', 'br', 'caption', 'center', 'cite', 'code',
+    'col', 'colgroup', 'dd', 'del', 'div', 'dl', 'dt', 'em', 'font', 'h1', 'h2', 'h3', 'h4', 'h5',
+    'h6', 'hr', 'i', 'img', 'ins', 'kbd', 'li', 'ol', 'p', 'pre', 'q', 's', 'small', 'span',
+    'strike', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'tt',
+    'u', 'ul'
+}
+VOID_TAGS = {'br', 'col', 'hr', 'img'}
+
+# Dropped together with everything inside them
+DROP_CONTENT_TAGS = {
+    'script', 'style', 'head', 'title', 'iframe', 'frame', 'frameset', 'object', 'embed',
+    'applet', 'noscript', 'template', 'svg', 'math', 'select', 'textarea', 'button'
+}
+
+ALLOWED_ATTRIBUTES = {
+    'align', 'alt', 'bgcolor', 'border', 'cellpadding', 'cellspacing', 'color', 'colspan', 'dir',
+    'face', 'height', 'href', 'hspace', 'lang', 'rowspan', 'size', 'src', 'style', 'title',
+    'valign', 'vspace', 'width', 'background'
+}
+URL_ATTRIBUTES = {'href', 'src', 'background'}
+LINK_SCHEMES = ('http:', 'https:', 'mailto:', 'tel:', '#')
+IMAGE_SCHEMES = ('http:', 'https:', 'data:image/')
+
+# Inline styles able to run code or escape the message area
+UNSAFE_STYLE = re.compile(r'expression\s*\(|javascript:|behavior\s*:|-moz-binding|@import|position\s*:\s*(fixed|absolute)', re.I)
+
+
+class _Sanitizer(HTMLParser):
+    """Rebuild HTML keeping only allow-listed tags and attributes"""
+
+    def __init__(self, inline_url):
+        super().__init__(convert_charrefs=True)
+        self.inline_url = inline_url
+        self.parts = []
+        self._open = []
+        self._drop_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            if tag not in VOID_TAGS:
+                self._drop_depth += 1
+            return
+        if self._drop_depth or tag not in ALLOWED_TAGS:
+            return
+
+        kept = []
+        for name, value in attrs:
+            value = self._attribute(tag, name, value or '')
+            if value is not None:
+                kept.append(f' {name}="{escape(value)}"')
+        if tag == 'a':
+            kept.append(' target="_blank" rel="noopener noreferrer"')
+
+        self.parts.append(f"<{tag}{''.join(kept)}>")
+        if tag not in VOID_TAGS:
+            self._open.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS and self._open and self._open[-1] == tag:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT_TAGS:
+            if self._drop_depth:
+                self._drop_depth -= 1
+            return
+        if self._drop_depth or tag not in self._open:
+            # Stray closing tag
+            return
+        while self._open:
+            open_tag = self._open.pop()
+            self.parts.append(f'</{open_tag}>')
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if not self._drop_depth:
+            self.parts.append(escape(data, quote=False))
+
+    def _attribute(self, tag, name, value):
+        """Sanitized attribute value, or None to drop the attribute"""
+        if name not in ALLOWED_ATTRIBUTES:
+            return None
+        if name == 'style':
+            return None if UNSAFE_STYLE.search(value) else value
+        if name in URL_ATTRIBUTES:
+            url = value.strip()
+            lowered = re.sub(r'[\s\x00-\x1f]', '', url).lower()
+            if lowered.startswith('cid:'):
+                return self.inline_url(url[4:].strip('<>'))
+            if name == 'href':
+                return url if lowered.startswith(LINK_SCHEMES) else None
+            return url if lowered.startswith(IMAGE_SCHEMES) else None
+        return value
+
+    def result(self):
+        self.close()
+        return ''.join(self.parts) + ''.join(f'</{tag}>' for tag in reversed(self._open))
+
+
+def sanitize_html(html, email_id=None, inline_cids=()):
+    """Sanitized HTML with cid: images rewritten to the inline endpoint"""
+    if not html:
+        return None
+    inline_cids = set(inline_cids)
+
+    def inline_url(cid):
+        # Unknown CIDs cannot be displayed; drop the reference
+        if email_id is None or cid not in inline_cids:
+            return None
+        return INLINE_URL_TEMPLATE.format(email_id=email_id, cid=quote(cid))
+
+    sanitizer = _Sanitizer(inline_url)
+    sanitizer.feed(html)
+    return sanitizer.result()
+
+
+def build_body(email, email_id=None):
+    """Processed body of a message: {'version', 'html', 'text'}"""
+    html = email.get('html') or email.get('message')
+    inline_cids = [inline.get('cid') for inline in email.get('inlines') or [] if isinstance(inline, dict)]
+    return {
+        'version': BODY_VERSION,
+        'html': sanitize_html(html, email_id, inline_cids),
+        'text': email.get('text') or html_to_text(html)
+    }
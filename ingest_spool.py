@@ -0,0 +1,310 @@
+"""
+Durable ingest spool for the ImprovMX webhook
+The webhook appends each payload to a local fsync'd append-only file and
+answers right away. A background writer drains the spool into MongoDB with
+insert_many in size- and time-bounded batches.
+
+Each worker process owns one spool file (spool-<pid>.log) guarded by an
+exclusive flock. Files left behind by dead workers are replayed by the next
+worker that starts. The drained position is checkpointed in <file>.offset,
+and every record carries its final _id, so a replay after a crash between
+insert and checkpoint only produces duplicate-key errors, which are ignored.
+Records that can never be stored (unparseable, failing to encode, too large,
+or rejected by the server) are moved to dead-letter.log so they never block
+the records behind them. MongoDB errors while preparing a record are
+transient: the batch is retried without moving the checkpoint.
+"""
+
+import os
+import glob
+import time
+import fcntl
+import logging
+import threading
+from datetime import datetime
+
+import bson
+from bson import json_util
+from bson.errors import InvalidDocument
+from pymongo.errors import BulkWriteError, DocumentTooLarge, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Spool configuration
+SPOOL_DIR = os.getenv('SPOOL_DIR', 'spool')
+SPOOL_BATCH_SIZE = int(os.getenv('SPOOL_BATCH_SIZE', '100'))  # Max records per insert_many
+SPOOL_BATCH_BYTES = int(os.getenv('SPOOL_BATCH_BYTES', str(16 * 1024 * 1024)))  # Max bytes per insert_many
+SPOOL_FLUSH_INTERVAL = float(os.getenv('SPOOL_FLUSH_INTERVAL', '1.0'))  # Max seconds a record waits
+SPOOL_ROTATE_BYTES = int(os.getenv('SPOOL_ROTATE_BYTES', str(64 * 1024 * 1024)))  # Truncate drained file above this size
+SPOOL_RETRY_DELAY = 5.0  # Seconds to wait after a failed flush
+
+DUPLICATE_KEY_ERROR = 11000
+MAX_DOCUMENT_BYTES = 16 * 1024 * 1024  # MongoDB BSON document limit
+
+
+def _read_offset(offset_path):
+    try:
+        with open(offset_path, 'r') as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _write_offset(offset_path, offset):
+    tmp_path = offset_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, offset_path)
+
+
+class IngestSpool:
+    """Append-only spool plus a batched background writer for one worker"""
+
+    def __init__(self, collection, prepare=None, on_insert=None, directory=SPOOL_DIR,
+                 batch_size=SPOOL_BATCH_SIZE, batch_bytes=SPOOL_BATCH_BYTES,
+                 flush_interval=SPOOL_FLUSH_INTERVAL):
+        self.collection = collection
+        self.prepare = prepare
+        self.on_insert = on_insert
+        self.directory = os.path.abspath(directory)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f'spool-{os.getpid()}.log')
+        self.offset_path = self.path + '.offset'
+        self.dead_letter_path = os.path.join(self.directory, 'dead-letter.log')
+
+        self._file = open(self.path, 'ab')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        self._offset = _read_offset(self.offset_path)
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pending = self._count_records(self.path, self._offset)
+        self._oldest_pending_at = time.monotonic() if self._pending else None
+
+        # Writer statistics
+        self.flushed_total = 0
+        self.dead_lettered_total = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = None
+        self.last_flush_at = None
+        self.last_error = None
+
+    def append(self, document):
+        """Durably append one document; returns once it is fsync'd"""
+        line = json_util.dumps(document).encode('utf-8') + b'\n'
+        with self._cond:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending += 1
+            if self._oldest_pending_at is None:
+                self._oldest_pending_at = time.monotonic()
+            if self._pending >= self.batch_size:
+                self._cond.notify()
+
+    def start(self):
+        """Replay orphaned spools and start the background writer"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='ingest-spool-writer', daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        """Spool depth and flush latency for health reporting"""
+        with self._cond:
+            pending_bytes = os.path.getsize(self.path) - self._offset
+            return {
+                'pending_records': self._pending,
+                'pending_bytes': pending_bytes,
+                'flushed_total': self.flushed_total,
+                'dead_lettered_total': self.dead_lettered_total,
+                'last_batch_size': self.last_batch_size,
+                'last_flush_ms': self.last_flush_ms,
+                'last_flush_at': self.last_flush_at.isoformat() if self.last_flush_at else None,
+                'last_error': self.last_error
+            }
+
+    # Background writer
+
+    def _run(self):
+        orphans_left = not self._replay_orphans()
+        while True:
+            with self._cond:
+                while not self._batch_due() and not orphans_left:
+                    self._cond.wait(timeout=self.flush_interval)
+            try:
+                self._drain_own()
+                if orphans_left:
+                    orphans_left = not self._replay_orphans()
+                    if orphans_left:
+                        time.sleep(SPOOL_RETRY_DELAY)
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"Spool flush failed, retrying in {SPOOL_RETRY_DELAY}s: {str(e)}")
+                time.sleep(SPOOL_RETRY_DELAY)
+
+    def _batch_due(self):
+        if self._pending == 0:
+            return False
+        if self._pending >= self.batch_size:
+            return True
+        return time.monotonic() - self._oldest_pending_at >= self.flush_interval
+
+    def _drain_own(self):
+        self._drain(self.path, self._offset, self.offset_path, own=True)
+
+        # Truncate the file once everything is drained and it grew large
+        with self._cond:
+            if self._pending == 0 and self._offset >= SPOOL_ROTATE_BYTES \
+                    and os.path.getsize(self.path) == self._offset:
+                self._file.truncate(0)
+                self._offset = 0
+                _write_offset(self.offset_path, 0)
+
+    def _replay_orphans(self):
+        """
+        Drain spool files left behind by workers that are no longer running;
+        returns False when one of them has to be retried
+        """
+        replayed = True
+        for path in glob.glob(os.path.join(self.directory, 'spool-*.log')):
+            if path == self.path:
+                continue
+            try:
+                spool_file = open(path, 'ab')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(spool_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Owned by a live worker
+                spool_file.close()
+                continue
+
+            offset_path = path + '.offset'
+            try:
+                logger.info(f"Replaying orphaned spool {path}")
+                self._drain(path, _read_offset(offset_path), offset_path, own=False)
+                os.unlink(path)
+                if os.path.exists(offset_path):
+                    os.unlink(offset_path)
+            except Exception as e:
+                replayed = False
+                self.last_error = str(e)
+                logger.error(f"Error replaying spool {path}: {str(e)}")
+            finally:
+                spool_file.close()
+        return replayed
+
+    def _drain(self, path, offset, offset_path, own):
+        """Insert every complete record after offset; returns the new offset"""
+        with open(path, 'rb') as reader:
+            reader.seek(offset)
+            while True:
+                batch, batch_bytes = [], 0
+                while len(batch) < self.batch_size and batch_bytes < self.batch_bytes:
+                    line = reader.readline()
+                    if not line or not line.endswith(b'\n'):
+                        # End of file or a torn write at the tail
+                        break
+                    batch.append(line)
+                    batch_bytes += len(line)
+
+                if not batch:
+                    return offset
+
+                self._insert_batch(batch)
+                offset += batch_bytes
+                _write_offset(offset_path, offset)
+
+                if own:
+                    with self._cond:
+                        self._offset = offset
+                        self._pending = max(0, self._pending - len(batch))
+                        self._oldest_pending_at = time.monotonic() if self._pending else None
+
+    def _dead_letter(self, line, reason):
+        """Set aside a record that can never be stored"""
+        logger.error(f"Moving unprocessable spool record to dead letter file: {reason}")
+        with open(self.dead_letter_path, 'ab') as dead_letter:
+            dead_letter.write(line)
+        self.dead_lettered_total += 1
+        self.last_error = f"Record moved to {self.dead_letter_path}: {reason}"
+
+    def _insert_batch(self, lines):
+        documents, sources = [], []
+        dead_lettered = self.dead_lettered_total
+        for line in lines:
+            try:
+                document = json_util.loads(line)
+            except ValueError as e:
+                self._dead_letter(line, f"unparseable record: {str(e)}")
+                continue
+
+            if self.prepare:
+                try:
+                    document = self.prepare(document)
+                except (PyMongoError, OSError):
+                    # MongoDB or the blob store is unavailable: retry the whole batch
+                    raise
+                except Exception as e:
+                    # Fails the same way on every retry and must not block the spool
+                    self._dead_letter(line, f"could not prepare record: {str(e)}")
+                    continue
+
+            # Encoding errors and oversized documents would fail the whole batch client-side
+            try:
+                if len(bson.encode(document)) > MAX_DOCUMENT_BYTES:
+                    raise DocumentTooLarge(f"document exceeds {MAX_DOCUMENT_BYTES} bytes")
+            except (InvalidDocument, OverflowError) as e:
+                self._dead_letter(line, str(e))
+                continue
+            documents.append(document)
+            sources.append(line)
+
+        start = time.monotonic()
+        inserted = documents
+        if documents:
+            try:
+                self.collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # Unordered: every other document was inserted. Duplicates were
+                # stored by a previous, interrupted flush; anything else is
+                # rejected by the server for good
+                failed = set()
+                for error in e.details.get('writeErrors', []):
+                    index = error.get('index')
+                    failed.add(index)
+                    if error.get('code') != DUPLICATE_KEY_ERROR:
+                        self._dead_letter(sources[index], error.get('errmsg', f"write error {error.get('code')}"))
+                inserted = [document for index, document in enumerate(documents) if index not in failed]
+
+        self.last_flush_ms = round((time.monotonic() - start) * 1000, 2)
+        self.last_batch_size = len(documents)
+        self.last_flush_at = datetime.utcnow()
+        self.flushed_total += len(documents)
+        if self.dead_lettered_total == dead_lettered:
+            self.last_error = None
+        logger.info(f"Spool flushed {len(documents)} email(s) in {self.last_flush_ms}ms")
+
+        if inserted and self.on_insert:
+            try:
+                self.on_insert(inserted)
+            except Exception as e:
+                logger.error(f"Error in spool insert callback: {str(e)}")
+
+    @staticmethod
+    def _count_records(path, offset):
+        count = 0
+        with open(path, 'rb') as reader:
+            reader.seek(offset)
+            for line in reader:
+                if line.endswith(b'\n'):
+                    count += 1
+        return count
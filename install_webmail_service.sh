@@ -20,6 +20,8 @@ fi
 # Configuration
 SERVICE_NAME="webmail"
 SERVICE_FILE="$SERVICE_NAME.service"
+OUTBOUND_SERVICE_NAME="webmail-outbound"
+OUTBOUND_SERVICE_FILE="$OUTBOUND_SERVICE_NAME.service"
 INSTALL_DIR="/home/jose/webmail_improvmx"
 WEBMAIL_DIR="$INSTALL_DIR/webmail"
 VENV_DIR="$INSTALL_DIR/venv"
@@ -155,6 +157,8 @@ fi
 echo "📋 Installing systemd service..."
 cp "$WEBMAIL_DIR/$SERVICE_FILE" "$SYSTEMD_DIR/$SERVICE_FILE"
 echo "✅ Service file installed to $SYSTEMD_DIR/$SERVICE_FILE"
+cp "$WEBMAIL_DIR/$OUTBOUND_SERVICE_FILE" "$SYSTEMD_DIR/$OUTBOUND_SERVICE_FILE"
+echo "✅ Service file installed to $SYSTEMD_DIR/$OUTBOUND_SERVICE_FILE"
 
 # Reload systemd daemon
 echo "🔄 Reloading systemd daemon..."
@@ -178,6 +182,11 @@ echo "🚀 Starting service..."
 systemctl start "$SERVICE_NAME"
 sleep 2
 
+# Outbound mail worker (delivers the messages queued by /send-email)
+echo "🚀 Enabling and (re)starting outbound mail worker..."
+systemctl enable "$OUTBOUND_SERVICE_NAME"
+systemctl restart "$OUTBOUND_SERVICE_NAME"
+
 # Check service status
 echo ""
 echo "📊 Service Status:"
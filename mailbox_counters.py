@@ -0,0 +1,341 @@
+"""
+Maintained per-user, per-folder message counters
+Keeps {total, unread} per (user, folder) plus a global counter for the admin
+"all" view in the mailbox_counters collection, updated with $inc whenever
+mail is received, read, trashed, deleted, sent or saved as draft, so
+listings and unread badges never need to count documents. Inbox counters
+follow each user's mailbox entries (mailbox_entries.py): entries in the
+trash are not counted and unread means not seen by that user. The global
+counter follows the emails themselves and their shared processed flag. The
+per-user thread rollups (threads.py) are updated in the same pass, and a
+threads counter per user follows how many of them exist.
+
+Counters are only incremented when they already exist; a missing counter is
+seeded by counting once on first read. Received emails are stored with
+entries_pending set, which is cleared once their fan-out succeeded. The
+reconciliation job fans out the emails still marked (and only those),
+corrects counter drift and removes unreferenced attachment blobs:
+
+    python mailbox_counters.py reconcile
+"""
+
+import sys
+import logging
+
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import DuplicateKeyError
+
+from email_fields import RECIPIENT_SOURCE_FIELDS, build_recipients
+from mailbox_entries import ENTRIES_COLLECTION, ENTRY_SOURCE_FIELDS, add_entries, folder_query
+from threads import (
+    THREADS_COLLECTION, thread_operations, unread_operations, apply_thread_operations, remove_from_threads
+)
+
+logger = logging.getLogger(__name__)
+
+COUNTERS_COLLECTION = 'mailbox_counters'
+PENDING_FIELD = 'entries_pending'  # Set on received emails until their fan-out succeeded
+GLOBAL_KEY = 'all'  # Every received email (admin "all" folder)
+FOLDERS = ('inbox', 'sent', 'drafts', 'threads')
+
+
+def counter_key(user_id, folder):
+    return f"{user_id}:{folder}"
+
+
+def mailbox_query(user_id):
+    """Query matching the received emails routed to a user (user_ids stamped at ingest)"""
+    return {'user_ids': str(user_id)}
+
+
+def _recipients(email):
+    return email.get('recipients') or build_recipients(email)
+
+
+def resolve_owner_ids(db, emails):
+    """
+    Map each email's _id to the ids of the users whose mailbox it lands in:
+    the user_ids stamped at ingest, else resolved from the users' addresses
+    """
+    owners = {email['_id']: set(email['user_ids']) for email in emails if 'user_ids' in email}
+    emails = [email for email in emails if 'user_ids' not in email]
+    addresses = sorted({address for email in emails for address in _recipients(email)})
+    if not addresses:
+        return {**owners, **{email['_id']: set() for email in emails}}
+
+    owners_by_address = {}
+    for user in db['users'].find(
+            {'$or': [{'email': {'$in': addresses}}, {'aliases': {'$in': addresses}}]},
+            {'email': 1, 'aliases': 1}):
+        for address in [user.get('email')] + (user.get('aliases') or []):
+            if address:
+                owners_by_address.setdefault(address.strip().lower(), set()).add(str(user['_id']))
+
+    return {**owners, **{
+        email['_id']: set().union(*[owners_by_address.get(address, set()) for address in _recipients(email)])
+        for email in emails
+    }}
+
+
+def _apply(db, increments):
+    """Apply {key: {'total': n, 'unread': m}} to the counters that exist"""
+    operations = []
+    for key, fields in increments.items():
+        fields = {field: delta for field, delta in fields.items() if delta}
+        if fields:
+            operations.append(UpdateOne({'_id': key}, {'$inc': fields}))
+    if operations:
+        db[COUNTERS_COLLECTION].bulk_write(operations, ordered=False)
+
+
+def _inbox_increments(entries, total, unread):
+    """Counter deltas for entries in the state they are counted in (trashed entries are not)"""
+    increments = {}
+    for entry in entries:
+        if entry['flags'].get('trashed'):
+            continue
+        counts = increments.setdefault(counter_key(entry['user_id'], 'inbox'), {'total': 0, 'unread': 0})
+        counts['total'] += total
+        counts['unread'] += 0 if entry['flags'].get('seen') else unread
+    return increments
+
+
+def _thread_increments(threads, sign):
+    """Counter deltas for {user_id: number of rollups created or deleted}"""
+    return {counter_key(user_id, 'threads'): {'total': sign * count} for user_id, count in threads.items()}
+
+
+def _fan_out(db, emails):
+    """
+    Create the missing mailbox entries of emails and add them to the thread
+    rollups; returns (entries, {user_id: rollups created})
+    """
+    entries = add_entries(db, emails, resolve_owner_ids(db, emails))
+    threads = apply_thread_operations(db, thread_operations(entries, {email['_id']: email for email in emails}, 1))
+    return entries, threads
+
+
+def _clear_pending(db, emails):
+    db['emails'].update_many(
+        {'_id': {'$in': [email['_id'] for email in emails]}, PENDING_FIELD: True},
+        {'$unset': {PENDING_FIELD: ''}}
+    )
+
+
+def record_received(db, emails):
+    """
+    Fan newly stored emails out to their recipients' mailboxes and count them.
+    On failure the emails keep entries_pending for repair_pending_entries
+    """
+    try:
+        entries, threads = _fan_out(db, emails)
+        increments = {**_inbox_increments(entries, 1, 1), **_thread_increments(threads, 1)}
+        increments[GLOBAL_KEY] = {
+            'total': len(emails),
+            'unread': sum(1 for email in emails if not email.get('processed', True))
+        }
+        _apply(db, increments)
+        _clear_pending(db, emails)
+    except Exception as e:
+        logger.error(f"Error fanning out {len(emails)} received email(s), left for reconcile: {str(e)}")
+
+
+def repair_pending_entries(db, batch_size=500):
+    """
+    Fan out the emails whose fan-out failed at ingest; returns how many were
+    repaired. Counters are left to reconcile_counters
+    """
+    projection = {**RECIPIENT_SOURCE_FIELDS, **ENTRY_SOURCE_FIELDS,
+                  'recipients': 1, 'user_ids': 1, 'subject': 1, 'summary': 1}
+    repaired = 0
+    while True:
+        emails = list(db['emails'].find({PENDING_FIELD: True}, projection).limit(batch_size))
+        if not emails:
+            return repaired
+        entries, _ = _fan_out(db, emails)
+        _clear_pending(db, emails)
+        repaired += len(emails)
+        logger.info(f"Repaired fan-out of {len(emails)} email(s), {len(entries)} entry(ies) created")
+
+
+def record_entries_removed(db, entries):
+    """Uncount entries that left their inbox (trashed or deleted), as they were before"""
+    try:
+        _apply(db, _inbox_increments(entries, -1, -1))
+        _apply(db, _thread_increments(remove_from_threads(db, entries), -1))
+    except Exception as e:
+        logger.error(f"Error updating mailbox counters on delete: {str(e)}")
+
+
+def record_entries_restored(db, entries, emails):
+    """Count entries restored from the trash, as they are now"""
+    try:
+        threads = apply_thread_operations(db, thread_operations(entries, {email['_id']: email for email in emails}, 1))
+        _apply(db, {**_inbox_increments(entries, 1, 1), **_thread_increments(threads, 1)})
+    except Exception as e:
+        logger.error(f"Error updating mailbox counters on restore: {str(e)}")
+
+
+def record_seen_change(db, entries, delta):
+    """Adjust unread counts after entries were marked read (-1) or unread (+1)"""
+    try:
+        increments = {}
+        for entry in entries:
+            if not entry['flags'].get('trashed'):
+                increments.setdefault(counter_key(entry['user_id'], 'inbox'), {'unread': 0})['unread'] += delta
+        _apply(db, increments)
+        apply_thread_operations(db, unread_operations(entries, delta))
+    except Exception as e:
+        logger.error(f"Error updating unread counters: {str(e)}")
+
+
+def record_emails_deleted(db, emails):
+    """Remove deleted emails from the global counter"""
+    try:
+        _apply(db, {GLOBAL_KEY: {
+            'total': -len(emails),
+            'unread': -sum(1 for email in emails if not email.get('processed', True))
+        }})
+    except Exception as e:
+        logger.error(f"Error updating global counter on delete: {str(e)}")
+
+
+def record_processed_change(db, delta):
+    """Adjust the global unread count after emails' shared processed flag changed"""
+    try:
+        _apply(db, {GLOBAL_KEY: {'unread': delta}})
+    except Exception as e:
+        logger.error(f"Error updating global unread counter: {str(e)}")
+
+
+def record_folder_change(db, user_id, folder, delta):
+    """Adjust the total of a user's sent or drafts folder"""
+    try:
+        _apply(db, {counter_key(user_id, folder): {'total': delta}})
+    except Exception as e:
+        logger.error(f"Error updating {folder} counter: {str(e)}")
+
+
+def get_counts(db, key, count):
+    """
+    Return {'total', 'unread'} for a counter, seeding it with count() (a
+    callable returning the same dict) the first time it is read
+    """
+    counters = db[COUNTERS_COLLECTION]
+    document = counters.find_one({'_id': key})
+    if document:
+        return {'total': max(0, document.get('total', 0)), 'unread': max(0, document.get('unread', 0))}
+
+    counts = count()
+    try:
+        counters.insert_one({'_id': key, **counts})
+    except DuplicateKeyError:
+        # Seeded concurrently by another request
+        pass
+    return counts
+
+
+def count_inbox(db, user_id):
+    """Count total and unread entries of a user's inbox (trash excluded)"""
+    entries = db[ENTRIES_COLLECTION]
+    return {
+        'total': entries.count_documents(folder_query(user_id, 'inbox')),
+        'unread': entries.count_documents(folder_query(user_id, 'unread'))
+    }
+
+
+def count_threads(db, user_id):
+    """Count the conversations of a user's threaded inbox"""
+    return {
+        'total': db[THREADS_COLLECTION].count_documents({'user_id': str(user_id), 'count': {'$gt': 0}}),
+        'unread': 0
+    }
+
+
+def count_all(db):
+    """Count every received email and those nobody has read yet"""
+    emails = db['emails']
+    return {
+        'total': emails.count_documents({}),
+        'unread': emails.count_documents({'processed': False})
+    }
+
+
+def _count_by_user(collection):
+    return {
+        group['_id']: group['count']
+        for group in collection.aggregate([{'$group': {'_id': '$user_id', 'count': {'$sum': 1}}}])
+    }
+
+
+def _count_inboxes(db):
+    """{user_id: {'total', 'unread'}} from the entries outside the trash"""
+    return {
+        group['_id']: {'total': group['total'], 'unread': group['unread']}
+        for group in db[ENTRIES_COLLECTION].aggregate([
+            {'$match': {'flags.trashed': False}},
+            {'$group': {
+                '_id': '$user_id',
+                'total': {'$sum': 1},
+                'unread': {'$sum': {'$cond': ['$flags.seen', 0, 1]}}
+            }}
+        ])
+    }
+
+
+def reconcile_counters(db):
+    """Recount every counter from the collections; returns the keys that had drifted"""
+    expected = {GLOBAL_KEY: count_all(db)}
+
+    inbox_counts = _count_inboxes(db)
+    # Rollups left empty before empty ones were deleted on removal
+    db[THREADS_COLLECTION].delete_many({'count': {'$lte': 0}})
+    thread_counts = _count_by_user(db[THREADS_COLLECTION])
+    sent_counts = _count_by_user(db['sent_emails'])
+    draft_counts = _count_by_user(db['draft_emails'])
+    for user in db['users'].find({}, {'_id': 1}):
+        user_id = str(user['_id'])
+        expected[counter_key(user_id, 'inbox')] = inbox_counts.get(user_id, {'total': 0, 'unread': 0})
+        expected[counter_key(user_id, 'sent')] = {'total': sent_counts.get(user_id, 0), 'unread': 0}
+        expected[counter_key(user_id, 'drafts')] = {'total': draft_counts.get(user_id, 0), 'unread': 0}
+        expected[counter_key(user_id, 'threads')] = {'total': thread_counts.get(user_id, 0), 'unread': 0}
+
+    counters = db[COUNTERS_COLLECTION]
+    current = {document['_id']: document for document in counters.find()}
+    drifted = [
+        key for key, counts in expected.items()
+        if {field: current.get(key, {}).get(field) for field in counts} != counts
+    ]
+    if drifted:
+        counters.bulk_write(
+            [ReplaceOne({'_id': key}, {'_id': key, **expected[key]}, upsert=True) for key in drifted],
+            ordered=False
+        )
+
+    # Counters of deleted users
+    stale = [key for key in current if key not in expected]
+    if stale:
+        counters.delete_many({'_id': {'$in': stale}})
+    return drifted
+
+
+if __name__ == '__main__':
+    from db_indexes import get_database
+
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command != 'reconcile':
+        print(f"Usage: python {sys.argv[0]} reconcile")
+        sys.exit(2)
+
+    database = get_database()
+    repaired = repair_pending_entries(database)
+    print(f"✓ repaired fan-out of {repaired} email(s)")
+    drifted = reconcile_counters(database)
+    for key in drifted:
+        print(f"✓ corrected {key}")
+    print(f"✓ reconcile: {len(drifted)} counter(s) corrected")
+
+    # Attachment blobs of deleted messages (see blob_store.py)
+    from blob_store import get_blob_store, sweep_blobs
+    print(f"✓ removed {sweep_blobs(database, get_blob_store(database))} unreferenced blob(s)")
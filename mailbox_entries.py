@@ -0,0 +1,74 @@
+"""
+Per-user mailbox entries
+A received email keeps a single document in emails however many of our users
+it was sent to; each of them gets a small entry in mailbox_entries
+({user_id, email_id, received_at, thread_id, flags: {seen, trashed}}) that
+holds their own read and trash state. Inbox, unread and trash listings page
+over a user's entries and only load the summaries of that page from emails;
+the mailbox counters and thread rollups are derived from entries too.
+
+Entries are fanned out at ingest (mailbox_counters.record_received). Mail
+stored before entries existed (or whose fan-out failed) is handled by:
+
+    python migrations.py backfill-mailbox-entries
+"""
+
+from pymongo import UpdateOne
+
+ENTRIES_COLLECTION = 'mailbox_entries'
+
+# Fields the counters, rollups and listings read from an entry
+ENTRY_PROJECTION = {'user_id': 1, 'email_id': 1, 'received_at': 1, 'thread_id': 1, 'flags': 1}
+
+# Fields an entry is built from
+ENTRY_SOURCE_FIELDS = {'received_at': 1, 'thread_id': 1, 'processed': 1, 'trashed_at': 1}
+
+
+def entry_key(user_id, email_id):
+    return f"{user_id}:{email_id}"
+
+
+def folder_query(user_id, folder):
+    """Entries of a user's inbox, unread or trash folder"""
+    query = {'user_id': str(user_id), 'flags.trashed': folder == 'trash'}
+    if folder == 'unread':
+        query['flags.seen'] = False
+    return query
+
+
+def build_entry(user_id, email):
+    """
+    A user's entry for an email. New mail is unseen; mail stored before
+    entries existed starts from the legacy shared processed/trashed_at fields
+    """
+    return {
+        '_id': entry_key(user_id, email['_id']),
+        'user_id': str(user_id),
+        'email_id': email['_id'],
+        'received_at': email.get('received_at'),
+        'thread_id': email.get('thread_id'),
+        'flags': {'seen': bool(email.get('processed')), 'trashed': bool(email.get('trashed_at'))}
+    }
+
+
+def add_entries(db, emails, owners):
+    """
+    Insert the missing entries of emails for their owners (owners maps email
+    _id -> user ids); returns the entries actually created
+    """
+    entries = [
+        build_entry(user_id, email)
+        for email in emails
+        for user_id in sorted(owners.get(email['_id'], ()))
+    ]
+    if not entries:
+        return []
+    result = db[ENTRIES_COLLECTION].bulk_write([
+        UpdateOne({'_id': entry['_id']},
+                  {'$setOnInsert': {field: value for field, value in entry.items() if field != '_id'}},
+                  upsert=True)
+        for entry in entries
+    ], ordered=False)
+    # Re-delivered or re-migrated mail keeps its existing entries and state
+    created = set(result.upserted_ids.values())
+    return [entry for entry in entries if entry['_id'] in created]
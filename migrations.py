@@ -0,0 +1,177 @@
+"""
+Backfill migrations for emails stored before a derived field existed
+
+Usage:
+    python migrations.py <migration> [batch_size]
+    python migrations.py list
+
+Each migration only touches documents that still lack the field (or hold an
+outdated version of it), so it can be re-run safely and interrupted at any time.
+"""
+
+import sys
+import logging
+
+from pymongo import UpdateOne
+
+from db_indexes import get_database
+from html_body import BODY_VERSION, BODY_SOURCE_FIELDS, build_body
+from mailbox_counters import resolve_owner_ids
+from recipient_map import RecipientMap
+from mailbox_entries import ENTRIES_COLLECTION, ENTRY_PROJECTION, ENTRY_SOURCE_FIELDS, add_entries
+from threads import THREAD_SOURCE_FIELDS, assign_thread_id, thread_operations, apply_thread_operations
+from email_fields import (
+    SUMMARY_SOURCE_FIELDS, RECIPIENT_SOURCE_FIELDS, SEARCH_SOURCE_FIELDS,
+    build_summary, build_recipients, build_html_text
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def _backfill(collection, query, projection, build_update, batch_size):
+    """Apply build_update(document) to every document matching query, in bulk batches"""
+    updated = 0
+    batch = []
+    for document in collection.find(query, projection, no_cursor_timeout=True).batch_size(batch_size):
+        batch.append(UpdateOne({'_id': document['_id']}, build_update(document)))
+        if len(batch) >= batch_size:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+            logger.info(f"{collection.name}: {updated} document(s) updated")
+            batch = []
+    if batch:
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+    return updated
+
+
+def backfill_summary(db, batch_size=DEFAULT_BATCH_SIZE):
+    """Store the list-view summary on emails received before it existed"""
+    return _backfill(
+        db['emails'],
+        {'summary': {'$exists': False}},
+        SUMMARY_SOURCE_FIELDS,
+        lambda email: {'$set': {'summary': build_summary(email)}},
+        batch_size
+    )
+
+
+def backfill_recipients(db, batch_size=DEFAULT_BATCH_SIZE):
+    """Store the normalized recipients array used by mailbox queries"""
+    return _backfill(
+        db['emails'],
+        {'recipients': {'$exists': False}},
+        RECIPIENT_SOURCE_FIELDS,
+        lambda email: {'$set': {'recipients': build_recipients(email)}},
+        batch_size
+    )
+
+
+def backfill_html_text(db, batch_size=DEFAULT_BATCH_SIZE):
+    """Store the searchable plain text of HTML-only emails"""
+    return _backfill(
+        db['emails'],
+        {'html_text': {'$exists': False}, 'text': {'$in': [None, '']}, 'html': {'$type': 'string', '$ne': ''}},
+        SEARCH_SOURCE_FIELDS,
+        lambda email: {'$set': {'html_text': build_html_text(email)}},
+        batch_size
+    )
+
+
+def backfill_body(db, batch_size=DEFAULT_BATCH_SIZE):
+    """Build the processed body of emails stored before it (or its current version) existed"""
+    return _backfill(
+        db['emails'],
+        {'body.version': {'$ne': BODY_VERSION}},
+        BODY_SOURCE_FIELDS,
+        lambda email: {'$set': {'body': build_body(email, str(email['_id']))}},
+        batch_size
+    )
+
+
+def backfill_user_ids(db, batch_size=DEFAULT_BATCH_SIZE):
+    """Stamp the users each email routes to (current addresses and aliases) on mail stored before routing"""
+    routes = RecipientMap(db['users'], db['cache_versions'], policy='store')
+    return _backfill(
+        db['emails'],
+        {'user_ids': {'$exists': False}},
+        {**RECIPIENT_SOURCE_FIELDS, 'recipients': 1},
+        lambda email: {'$set': {'user_ids': sorted(routes.route(email.get('recipients') or build_recipients(email)))}},
+        batch_size
+    )
+
+
+def backfill_mailbox_entries(db, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Fan emails out to their owners' mailbox entries, starting from the legacy
+    shared processed and trashed_at state. Existing entries are left as they
+    are, so it also repairs a failed fan-out. Run backfill-threads afterwards
+    and then reconcile the counters (python mailbox_counters.py reconcile).
+    """
+    projection = {**RECIPIENT_SOURCE_FIELDS, **ENTRY_SOURCE_FIELDS, 'recipients': 1, 'user_ids': 1}
+    created = 0
+    batch = []
+    for email in db['emails'].find({}, projection, no_cursor_timeout=True).batch_size(batch_size):
+        batch.append(email)
+        if len(batch) >= batch_size:
+            created += len(add_entries(db, batch, resolve_owner_ids(db, batch)))
+            logger.info(f"{ENTRIES_COLLECTION}: {created} entry(ies) created")
+            batch = []
+    if batch:
+        created += len(add_entries(db, batch, resolve_owner_ids(db, batch)))
+    return created
+
+
+def backfill_threads(db, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Assign thread_id to emails stored before threading existed and add their
+    mailbox entries to the owners' thread rollups. Oldest first and one at a
+    time, since each assignment may depend on the threads of earlier mail.
+    """
+    emails = db['emails']
+    entries = db[ENTRIES_COLLECTION]
+    projection = {**THREAD_SOURCE_FIELDS, **RECIPIENT_SOURCE_FIELDS, 'summary': 1, 'user_ids': 1}
+    updated = 0
+    cursor = emails.find({'thread_id': {'$exists': False}}, projection, no_cursor_timeout=True)
+    for email in cursor.sort('received_at', 1).batch_size(batch_size):
+        owners = resolve_owner_ids(db, [email])
+        email['thread_id'] = assign_thread_id(db, email, owners[email['_id']])
+        result = emails.update_one(
+            {'_id': email['_id'], 'thread_id': {'$exists': False}},
+            {'$set': {'thread_id': email['thread_id']}}
+        )
+        if result.modified_count:
+            updated += 1
+            entries.update_many({'email_id': email['_id']}, {'$set': {'thread_id': email['thread_id']}})
+            threaded = list(entries.find({'email_id': email['_id']}, ENTRY_PROJECTION))
+            apply_thread_operations(db, thread_operations(threaded, {email['_id']: email}, 1))
+        if updated and updated % batch_size == 0:
+            logger.info(f"emails: {updated} document(s) threaded")
+    return updated
+
+
+MIGRATIONS = {
+    'backfill-summary': backfill_summary,
+    'backfill-recipients': backfill_recipients,
+    'backfill-html-text': backfill_html_text,
+    'backfill-body': backfill_body,
+    'backfill-user-ids': backfill_user_ids,
+    'backfill-mailbox-entries': backfill_mailbox_entries,
+    'backfill-threads': backfill_threads,
+}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    name = sys.argv[1] if len(sys.argv) > 1 else 'list'
+
+    if name not in MIGRATIONS:
+        print(f"Usage: python {sys.argv[0]} <migration> [batch_size]")
+        print("Available migrations:")
+        for migration in MIGRATIONS:
+            print(f"  {migration}")
+        sys.exit(0 if name == 'list' else 2)
+
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BATCH_SIZE
+    count = MIGRATIONS[name](get_database(), size)
+    print(f"✓ {name}: {count} document(s) updated")
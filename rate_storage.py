@@ -0,0 +1,180 @@
+"""
+Shared rate limit storage for the ImprovMX Webhook API
+A SQLite-backed storage for the `limits` library, so every gunicorn worker
+on the host sees the same counters. Registered under the `sqlite://` scheme:
+
+    sqlite:///ratelimit.sqlite3        (relative to the working directory)
+    sqlite:////var/lib/app/rl.sqlite3  (absolute path)
+
+Counters use the sliding window counter strategy (two O(1) fixed-window
+rows per key), expire with a TTL, and the table is capped at a maximum
+number of keys. Any other `limits` storage URI (e.g. redis://) can be used
+instead through RATELIMIT_STORAGE_URI.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from math import floor
+
+from limits.storage import Storage, storage_from_string
+from limits.storage.base import SlidingWindowCounterSupport, TimestampedSlidingWindow
+
+RATELIMIT_STORAGE_URI = os.getenv('RATELIMIT_STORAGE_URI', 'sqlite:///ratelimit.sqlite3')
+RATELIMIT_MAX_KEYS = int(os.getenv('RATELIMIT_MAX_KEYS', '100000'))  # Memory/disk cap
+EVICTION_INTERVAL = 30  # Seconds between expired-key sweeps
+
+
+def sqlite_path(uri):
+    """
+    Database path of a sqlite:// URI (the slash after the scheme separator
+    is dropped, so a fourth slash makes the path absolute)
+
+    >>> sqlite_path('sqlite:///ratelimit.sqlite3')
+    'ratelimit.sqlite3'
+    >>> sqlite_path('sqlite:////var/lib/app/rl.sqlite3')
+    '/var/lib/app/rl.sqlite3'
+    """
+    return uri.split('://', 1)[1][1:]
+
+
+class SQLiteStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    """Rate limit storage shared between processes through a SQLite file"""
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri=RATELIMIT_STORAGE_URI, wrap_exceptions=False, max_keys=RATELIMIT_MAX_KEYS, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.path = os.path.abspath(sqlite_path(uri))
+        self.max_keys = int(max_keys)
+        self._local = threading.local()
+        self._last_eviction = 0
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS counters ('
+            'key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires_at REAL NOT NULL)'
+        )
+        self._connection().execute(
+            'CREATE INDEX IF NOT EXISTS counters_expires_at ON counters (expires_at)'
+        )
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        """One connection per thread and per process (connections do not survive fork)"""
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = pid
+        return self._local.connection
+
+    def _incr(self, connection, key, expiry, amount, now):
+        connection.execute(
+            'INSERT INTO counters (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET '
+            'value = CASE WHEN expires_at <= ? THEN excluded.value ELSE value + excluded.value END, '
+            'expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END',
+            (key, amount, now + expiry, now, now)
+        )
+        return self._get(connection, key, now)
+
+    def _get(self, connection, key, now):
+        row = connection.execute(
+            'SELECT value FROM counters WHERE key = ? AND expires_at > ?', (key, now)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _evict(self, connection, now):
+        """Drop expired keys, then the soonest-expiring keys above the cap"""
+        if now - self._last_eviction < EVICTION_INTERVAL:
+            return
+        self._last_eviction = now
+        connection.execute('DELETE FROM counters WHERE expires_at <= ?', (now,))
+        overflow = connection.execute('SELECT COUNT(*) FROM counters').fetchone()[0] - self.max_keys
+        if overflow > 0:
+            connection.execute(
+                'DELETE FROM counters WHERE key IN '
+                '(SELECT key FROM counters ORDER BY expires_at LIMIT ?)', (overflow,)
+            )
+
+    def incr(self, key, expiry, amount=1):
+        connection = self._connection()
+        now = time.time()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            value = self._incr(connection, key, expiry, amount, now)
+            self._evict(connection, now)
+        return value
+
+    def get(self, key):
+        return self._get(self._connection(), key, time.time())
+
+    def get_expiry(self, key):
+        row = self._connection().execute(
+            'SELECT expires_at FROM counters WHERE key = ?', (key,)
+        ).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self):
+        try:
+            self._connection().execute('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        with self._connection() as connection:
+            return connection.execute('DELETE FROM counters').rowcount
+
+    def clear(self, key):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM counters WHERE key = ?', (key,))
+
+    # Sliding window counter support
+
+    def _sliding_window(self, connection, key, expiry, now):
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        previous_count = self._get(connection, previous_key, now)
+        current_count = self._get(connection, current_key, now)
+        if previous_count == 0:
+            previous_ttl = float(0)
+        else:
+            previous_ttl = (1 - (((now - expiry) / expiry) % 1)) * expiry
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_count, previous_ttl, current_count, current_ttl
+
+    def get_sliding_window(self, key, expiry):
+        return self._sliding_window(self._connection(), key, expiry, time.time())
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        connection = self._connection()
+        now = time.time()
+        # The whole check-and-increment runs in one write transaction, so
+        # concurrent workers cannot overshoot the limit
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            previous_count, previous_ttl, current_count, _ = self._sliding_window(connection, key, expiry, now)
+            weighted_count = previous_count * previous_ttl / expiry + current_count
+            if floor(weighted_count) + amount > limit:
+                return False
+            _, current_key = self.sliding_window_keys(key, expiry, now)
+            self._incr(connection, current_key, 2 * expiry, amount, now)
+            self._evict(connection, now)
+        return True
+
+    def clear_sliding_window(self, key, expiry):
+        previous_key, current_key = self.sliding_window_keys(key, expiry, time.time())
+        with self._connection() as connection:
+            connection.execute('DELETE FROM counters WHERE key IN (?, ?)', (previous_key, current_key))
+
+
+def get_rate_limit_storage(uri=RATELIMIT_STORAGE_URI):
+    """Create the shared storage configured by RATELIMIT_STORAGE_URI"""
+    return storage_from_string(uri)
@@ -0,0 +1,117 @@
+"""
+In-memory recipient routing for the webhook
+Maps every user address and alias to user ids, so each incoming email is
+routed with dictionary lookups instead of a users query. The map is reloaded
+when the webmail reports a user change (the 'users' version stamp its
+UserCache bumps in cache_versions, checked at most once per interval) and
+after a TTL, which also covers users edited directly in MongoDB.
+
+Mail for which no user matches follows UNKNOWN_RECIPIENT_POLICY:
+    store      keep it without owners (visible in the admin "all" folder)
+    reject     acknowledge it without storing anything
+    catch-all  deliver it to the user owning CATCH_ALL_ADDRESS
+"""
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+RECIPIENT_MAP_TTL = float(os.getenv('RECIPIENT_MAP_TTL', '60'))  # Seconds before a full reload
+RECIPIENT_MAP_VERSION_INTERVAL = float(os.getenv('RECIPIENT_MAP_VERSION_INTERVAL', '2'))  # Seconds between stamp checks
+UNKNOWN_RECIPIENT_POLICY = os.getenv('UNKNOWN_RECIPIENT_POLICY', 'store')
+CATCH_ALL_ADDRESS = os.getenv('CATCH_ALL_ADDRESS', '').strip().lower()
+
+POLICIES = ('store', 'reject', 'catch-all')
+
+# Bumped by the webmail's UserCache whenever a user is created, edited or deleted
+VERSION_KEY = 'users'
+
+
+class RecipientMap:
+    """Address -> user ids map with version-stamp and TTL refresh"""
+
+    def __init__(self, users, versions, policy=UNKNOWN_RECIPIENT_POLICY, catch_all=CATCH_ALL_ADDRESS,
+                 ttl=RECIPIENT_MAP_TTL, version_interval=RECIPIENT_MAP_VERSION_INTERVAL):
+        if policy not in POLICIES:
+            raise ValueError(f"UNKNOWN_RECIPIENT_POLICY must be one of {', '.join(POLICIES)}")
+        if policy == 'catch-all' and not catch_all:
+            raise ValueError("UNKNOWN_RECIPIENT_POLICY=catch-all requires CATCH_ALL_ADDRESS")
+        self.users = users
+        self.versions = versions
+        self.policy = policy
+        self.catch_all = catch_all
+        self.ttl = ttl
+        self.version_interval = version_interval
+        self._owners = {}
+        self._loaded_at = None
+        self._version = None
+        self._version_checked_at = 0
+        self._lock = threading.Lock()
+
+    def route(self, addresses):
+        """
+        User ids the addresses are delivered to, after applying the policy
+        for unknown recipients; None means the email must be rejected
+        """
+        owners = self._map()
+        user_ids = set()
+        for address in addresses:
+            user_ids |= owners.get(address.strip().lower(), frozenset())
+        if user_ids or self.policy == 'store':
+            return user_ids
+        if self.policy == 'reject':
+            return None
+        catch_all = owners.get(self.catch_all, frozenset())
+        if not catch_all:
+            logger.warning(f"Catch-all address {self.catch_all} has no user, storing without owners")
+        return set(catch_all)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'policy': self.policy,
+                'addresses': len(self._owners),
+                'age': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at is not None else None
+            }
+
+    def _map(self):
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at >= self.ttl or self._version_moved(now):
+            self._load()
+        return self._owners
+
+    def _version_moved(self, now):
+        if now - self._version_checked_at < self.version_interval:
+            return False
+        self._version_checked_at = now
+        try:
+            document = self.versions.find_one({'_id': VERSION_KEY})
+        except Exception as e:
+            logger.error(f"Error reading users version stamp: {str(e)}")
+            return False
+        return (document.get('version', 0) if document else 0) != self._version
+
+    def _load(self):
+        with self._lock:
+            try:
+                stamp = self.versions.find_one({'_id': VERSION_KEY})
+                owners = {}
+                for user in self.users.find({}, {'email': 1, 'aliases': 1}):
+                    for address in [user.get('email')] + (user.get('aliases') or []):
+                        if address:
+                            owners.setdefault(address.strip().lower(), set()).add(str(user['_id']))
+            except Exception as e:
+                # Keep routing with the previous map until the next TTL or stamp change
+                logger.error(f"Error loading recipient map: {str(e)}")
+                if self._loaded_at is None:
+                    raise
+                self._loaded_at = time.monotonic()
+                return
+            # Swapped in one assignment: concurrent requests see the old or the new map
+            self._owners = {address: frozenset(user_ids) for address, user_ids in owners.items()}
+            self._version = stamp.get('version', 0) if stamp else 0
+            self._loaded_at = time.monotonic()
+            logger.info(f"Recipient map loaded: {len(self._owners)} address(es)")
@@ -0,0 +1,224 @@
+"""
+Conversation threading
+Every received email gets a thread_id at ingest: the thread of the first
+stored message it references (In-Reply-To / References), else an id derived
+from the root reference, else the recent thread of a recipient with the same
+normalized subject, else a new thread. Per-user rollups in the threads
+collection ({user_id, thread_id, subject, last_date, count, unread,
+participants, ...}) are updated with the mailbox counters, so the threaded
+inbox pages over rollups and never groups messages per request. Rollups follow
+each user's own read and trash state (mailbox_entries.py): a rollup whose last
+message leaves the inbox is deleted, and one that loses its newest message
+takes the subject and preview of the newest one left.
+
+Mail stored before threading existed is handled by:
+
+    python migrations.py backfill-threads
+"""
+
+import re
+import hashlib
+from datetime import timedelta
+
+from pymongo import UpdateOne
+
+from mailbox_entries import ENTRIES_COLLECTION, folder_query
+
+THREADS_COLLECTION = 'threads'
+
+# A message without references joins a same-subject thread active this recently
+SUBJECT_THREAD_WINDOW = timedelta(days=30)
+
+# Fields thread assignment reads
+THREAD_SOURCE_FIELDS = {'message-id': 1, 'headers': 1, 'subject': 1, 'recipients': 1, 'received_at': 1}
+
+# Reply/forward prefixes (English, Spanish, German, ...) and [list] tags
+SUBJECT_PREFIX = re.compile(r'^\s*((re|fw|fwd|rv|aw|wg|sv|vs|tr|res|enc)(\[\d+\])?\s*:|\[[^\]]*\])\s*', re.I)
+MESSAGE_ID = re.compile(r'<([^<>\s]+)>')
+
+
+def normalize_subject(subject):
+    """Subject without reply/forward prefixes, lowercased and whitespace-collapsed"""
+    subject = subject or ''
+    previous = None
+    while previous != subject:
+        previous = subject
+        subject = SUBJECT_PREFIX.sub('', subject)
+    return ' '.join(subject.split()).lower()
+
+
+def _header(email, name):
+    """Header value by case-insensitive name, lists joined"""
+    for key, value in (email.get('headers') or {}).items():
+        if key.lower() == name:
+            return ' '.join(value) if isinstance(value, list) else str(value or '')
+    return ''
+
+
+def referenced_ids(email):
+    """Message-ids this email refers to, thread root first (References, then In-Reply-To)"""
+    ids = []
+    for header in ('references', 'in-reply-to'):
+        for message_id in MESSAGE_ID.findall(_header(email, header)):
+            if message_id not in ids:
+                ids.append(message_id)
+    return ids
+
+
+def _message_id(email):
+    return (email.get('message-id') or '').strip().strip('<>')
+
+
+def _derived_thread_id(message_id):
+    return hashlib.sha1(message_id.encode('utf-8')).hexdigest()[:24]
+
+
+def assign_thread_id(db, email, owner_ids=()):
+    """Thread id for an email that is about to be stored"""
+    references = referenced_ids(email)
+    if references:
+        # Stored messages may be stored with or without angle brackets
+        candidates = references + [f'<{message_id}>' for message_id in references]
+        parent = db['emails'].find_one(
+            {'message-id': {'$in': candidates}, 'thread_id': {'$exists': True}},
+            {'thread_id': 1}
+        )
+        if parent:
+            return parent['thread_id']
+        # Replies to mail we never stored (e.g. our own sent mail) share the root's id
+        return _derived_thread_id(references[0])
+
+    subject_key = normalize_subject(email.get('subject'))
+    if subject_key and owner_ids and email.get('received_at'):
+        recent = db[THREADS_COLLECTION].find_one(
+            {
+                'user_id': {'$in': list(owner_ids)},
+                'subject_key': subject_key,
+                'last_date': {'$gte': email['received_at'] - SUBJECT_THREAD_WINDOW}
+            },
+            {'thread_id': 1},
+            sort=[('last_date', -1)]
+        )
+        if recent:
+            return recent['thread_id']
+
+    message_id = _message_id(email)
+    if message_id:
+        return _derived_thread_id(message_id)
+    return str(email['_id'])
+
+
+def thread_key(user_id, thread_id):
+    return f"{user_id}:{thread_id}"
+
+
+def _counted(entry):
+    """Entries in the trash are not part of the inbox rollups"""
+    return entry.get('thread_id') and not entry['flags'].get('trashed')
+
+
+def thread_operations(entries, emails, count):
+    """
+    Rollup updates for mailbox entries entering (count=1) or leaving
+    (count=-1) their owner's inbox, in the state they are counted in; emails
+    maps email _id -> email for the preview of entering entries
+    """
+    operations = []
+    for entry in filter(_counted, entries):
+        key = thread_key(entry['user_id'], entry['thread_id'])
+        unread = 0 if entry['flags'].get('seen') else count
+        if count < 0:
+            operations.append(UpdateOne({'_id': key}, {'$inc': {'count': count, 'unread': unread}}))
+            continue
+
+        email = emails.get(entry['email_id']) or {}
+        summary = email.get('summary') or {}
+        update = {
+            '$setOnInsert': {'user_id': entry['user_id'], 'thread_id': entry['thread_id']},
+            '$inc': {'count': count, 'unread': unread},
+            '$max': {'last_date': entry.get('received_at')},
+        }
+        sender = summary.get('from_name') or summary.get('from_email')
+        if sender:
+            update['$addToSet'] = {'participants': sender}
+        operations.append(UpdateOne({'_id': key}, update, upsert=True))
+        # Subject and preview follow the newest message
+        operations.append(UpdateOne(
+            {'_id': key, 'last_date': entry.get('received_at')},
+            {'$set': _head_fields(entry, email)}
+        ))
+    return operations
+
+
+def _head_fields(entry, email):
+    """Rollup fields that follow the newest message of a thread"""
+    summary = email.get('summary') or {}
+    return {
+        'subject': summary.get('subject') or email.get('subject'),
+        'subject_key': normalize_subject(email.get('subject') or summary.get('subject')),
+        'snippet': summary.get('snippet', ''),
+        'last_email_id': entry['email_id']
+    }
+
+
+def unread_operations(entries, delta):
+    """Rollup updates after entries were marked read (-1) or unread (+1)"""
+    return [
+        UpdateOne({'_id': thread_key(entry['user_id'], entry['thread_id'])}, {'$inc': {'unread': delta}})
+        for entry in filter(_counted, entries)
+    ]
+
+
+def _by_user(keys):
+    """{user_id: n} for rollup keys"""
+    counts = {}
+    for key in keys:
+        user_id = key.split(':', 1)[0]
+        counts[user_id] = counts.get(user_id, 0) + 1
+    return counts
+
+
+def apply_thread_operations(db, operations):
+    """Apply rollup updates; returns {user_id: number of rollups created}"""
+    if not operations:
+        return {}
+    result = db[THREADS_COLLECTION].bulk_write(operations, ordered=True)
+    return _by_user(result.upserted_ids.values())
+
+
+def remove_from_threads(db, entries):
+    """
+    Take entries that left their owner's inbox out of the rollups: delete the
+    rollups left empty and refresh those that lost their newest message.
+    Returns {user_id: number of rollups deleted}
+    """
+    apply_thread_operations(db, thread_operations(entries, {}, -1))
+    keys = list({thread_key(entry['user_id'], entry['thread_id']) for entry in filter(_counted, entries)})
+    if not keys:
+        return {}
+
+    threads = db[THREADS_COLLECTION]
+    deleted = [
+        thread['_id'] for thread in threads.find({'_id': {'$in': keys}, 'count': {'$lte': 0}}, {'_id': 1})
+        # A message may have arrived meanwhile
+        if threads.delete_one({'_id': thread['_id'], 'count': {'$lte': 0}}).deleted_count
+    ]
+
+    removed_ids = [entry['email_id'] for entry in entries]
+    for thread in threads.find({'_id': {'$in': keys}, 'count': {'$gt': 0}, 'last_email_id': {'$in': removed_ids}},
+                               {'user_id': 1, 'thread_id': 1, 'last_email_id': 1}):
+        newest = db[ENTRIES_COLLECTION].find_one(
+            {**folder_query(thread['user_id'], 'inbox'), 'thread_id': thread['thread_id']},
+            {'email_id': 1, 'received_at': 1},
+            sort=[('received_at', -1)]
+        )
+        # Unless a newer message became the head meanwhile
+        unchanged = {'_id': thread['_id'], 'last_email_id': thread['last_email_id']}
+        if newest is None:
+            # Its count had drifted: nothing is left in the inbox
+            if threads.delete_one(unchanged).deleted_count:
+                deleted.append(thread['_id'])
+            continue
+        email = db['emails'].find_one({'_id': newest['email_id']}, {'subject': 1, 'summary': 1}) or {}
+        threads.update_one(unchanged, {'$set': {**_head_fields(newest, email), 'last_date': newest.get('received_at')}})
+    return _by_user(deleted)
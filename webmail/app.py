@@ -3,20 +3,34 @@ Webmail Application - ImprovMX
 A webmail interface to view emails stored in MongoDB
 """
 
-from flask import Flask, request, render_template, jsonify, redirect, url_for, flash, send_file
+from flask import Flask, Response, request, render_template, jsonify, redirect, url_for, flash
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-import base64
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateMany, DeleteMany
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 import os
-from datetime import datetime
+import sys
+from datetime import datetime, timedelta
+from collections import Counter
 import logging
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
 from werkzeug.security import generate_password_hash, check_password_hash
+from user_cache import UserCache
+from mail_events import MailEventHub
+from outbound_worker import STATUS_SENT, queue_state, split_addresses
+
+# Shared modules (attachment store, indexes, ...) live in the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from blob_store import get_blob_store
+from attachment_stream import attachment_response
+from db_indexes import ensure_indexes_in_background
+from email_fields import SUMMARY_SOURCE_FIELDS, build_summary
+from html_body import BODY_VERSION, BODY_SOURCE_FIELDS, build_body
+from mailbox_entries import ENTRIES_COLLECTION, ENTRY_PROJECTION, entry_key, folder_query
+from mailbox_counters import (
+    GLOBAL_KEY, counter_key, mailbox_query, get_counts, count_inbox, count_threads, count_all,
+    record_entries_removed, record_entries_restored, record_seen_change,
+    record_emails_deleted, record_processed_change, record_folder_change
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -44,6 +58,28 @@ emails_collection = db['emails']
 users_collection = db['users']
 sent_emails_collection = db['sent_emails']
 draft_emails_collection = db['draft_emails']
+threads_collection = db['threads']
+entries_collection = db[ENTRIES_COLLECTION]
+user_cache = UserCache(users_collection, db['cache_versions'])
+attachment_store = get_blob_store(db)
+
+# Searches inside a folder: ids inlined in the query up to this many, else
+# matches are checked against the user's entries, up to SEARCH_SCAN_LIMIT of them
+SEARCH_FOLDER_ID_LIMIT = int(os.getenv('SEARCH_FOLDER_ID_LIMIT', '1000'))
+SEARCH_SCAN_LIMIT = int(os.getenv('SEARCH_SCAN_LIMIT', '2000'))
+SEARCH_SCAN_BATCH = 200  # Matches checked per entries query
+
+# Live new-mail events: one change stream per worker, opened on first use.
+# Each /events connection stays open, so it is only served by worker classes
+# that do not tie up a worker per connection (gunicorn.conf.py exports the
+# class in use; gunicorn's own default is sync)
+EVENTS_WORKER_CLASSES = {'gevent', 'gthread', 'gunicorn.workers.ggevent.GeventWorker',
+                         'gunicorn.workers.gthread.ThreadWorker'}
+LIVE_EVENTS = os.getenv('GUNICORN_WORKER_CLASS', 'sync') in EVENTS_WORKER_CLASSES
+mail_events = MailEventHub(db)
+
+# Build required indexes in the background (see db_indexes.py)
+ensure_indexes_in_background(db)
 
 # User class for Flask-Login
 class User(UserMixin):
@@ -56,7 +92,7 @@ class User(UserMixin):
 
 @login_manager.user_loader
 def load_user(user_id):
-    user_data = users_collection.find_one({'_id': ObjectId(user_id)})
+    user_data = user_cache.get(user_id)
     if user_data:
         return User(user_data)
     return None
@@ -84,25 +120,246 @@ def is_admin():
     return current_user.is_authenticated and current_user.role == 'admin'
 
 
-def build_email_query(email_address, aliases=None):
-    """Build MongoDB query to filter emails by recipient"""
-    if not email_address:
+# Inbox listings only need the precomputed summary
+EMAIL_LIST_PROJECTION = {'summary': 1, 'received_at': 1, 'processed': 1}
+
+
+def get_user_email_query():
+    """Mailbox query for the authenticated user (mail routed to their address or aliases at ingest)"""
+    return mailbox_query(current_user.id)
+
+
+def get_inbox_counts(all_emails=False):
+    """Maintained total/unread counts of the user's inbox (or of every email)"""
+    if all_emails:
+        return get_counts(db, GLOBAL_KEY, lambda: count_all(db))
+    return get_counts(db, counter_key(current_user.id, 'inbox'),
+                      lambda: count_inbox(db, current_user.id))
+
+
+def get_folder_total(folder, collection):
+    """Maintained number of messages in the user's sent or drafts folder"""
+    return get_counts(db, counter_key(current_user.id, folder), lambda: {
+        'total': collection.count_documents({'user_id': current_user.id}),
+        'unread': 0
+    })['total']
+
+
+# Message locator: sent and draft IDs carry their folder, so any message is
+# opened with a single find_one on the right collection
+MESSAGE_ID_PREFIXES = {'sent': 's-', 'drafts': 'd-'}
+
+# A message view reads the processed body, never the raw bodies, derived
+# fields or (legacy) embedded file content
+MESSAGE_VIEW_PROJECTION = {
+    'html': 0, 'text': 0, 'message': 0, 'summary': 0, 'html_text': 0, 'ingest_key': 0,
+    'attachments.content': 0, 'inlines.content': 0
+}
+
+# Inline images never change once received
+INLINE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Fields reply, reply-all and forward quote from
+MESSAGE_REPLY_PROJECTION = {
+    'from': 1, 'to': 1, 'subject': 1, 'text': 1, 'html': 1, 'message': 1,
+    'received_at': 1, 'sent_at': 1, 'updated_at': 1
+}
+
+# Fields the mailbox counters and thread rollups need to account for a changed message
+COUNTER_PROJECTION = {
+    'user_id': 1, 'processed': 1, 'thread_id': 1, 'received_at': 1, 'subject': 1, 'summary': 1
+}
+
+# Bulk actions on received mail: mailbox entries they apply to, and the update
+BULK_ACTIONS = {
+    'delete': ({}, None),
+    'trash': ({'flags.trashed': False}, {'$set': {'flags.trashed': True}}),
+    'restore': ({'flags.trashed': True}, {'$set': {'flags.trashed': False}}),
+    'mark_read': ({'flags.seen': False}, {'$set': {'flags.seen': True}}),
+    'mark_unread': ({'flags.seen': True}, {'$set': {'flags.seen': False}})
+}
+BULK_MAX_IDS = 1000
+
+
+def message_collection(folder):
+    return {'sent': sent_emails_collection, 'drafts': draft_emails_collection}.get(folder, emails_collection)
+
+
+def message_ref(folder, message_id):
+    """Public message ID: '<oid>' for received mail, 's-<oid>' / 'd-<oid>' for sent and drafts"""
+    return f"{MESSAGE_ID_PREFIXES.get(folder, '')}{message_id}"
+
+
+def parse_message_ref(ref):
+    """Split a message ID into (folder, ObjectId); unprefixed IDs are received mail ('inbox')"""
+    for folder, prefix in MESSAGE_ID_PREFIXES.items():
+        if ref.startswith(prefix):
+            return folder, ObjectId(ref[len(prefix):])
+    return 'inbox', ObjectId(ref)
+
+
+def message_access_query(folder):
+    """Predicate restricting a folder to what the current user may see"""
+    if is_admin():
         return {}
+    if folder == 'inbox':
+        return get_user_email_query()
+    return {'user_id': current_user.id}
+
+
+def find_message(ref, projection=None):
+    """
+    Fetch a message the current user may access, tagged with its '_folder';
+    None when the ID is malformed, or the message does not exist or belongs
+    to someone else
+    """
+    try:
+        folder, message_id = parse_message_ref(ref)
+    except InvalidId:
+        return None
+    message = message_collection(folder).find_one({'_id': message_id, **message_access_query(folder)}, projection)
+    if message:
+        message['_folder'] = folder
+    return message
+
+
+def get_message_body(email):
+    """Processed body of a located message, rebuilt and stored if missing or outdated"""
+    body = email.get('body')
+    if body and body.get('version') == BODY_VERSION:
+        return body
     
-    # Build list of emails to search (main email + aliases)
-    email_list = [email_address]
-    if aliases:
-        email_list.extend(aliases)
-    
-    # Create query for each email address
-    email_queries = []
-    for email in email_list:
-        email_queries.append({"to.email": email})
-        email_queries.append({"envelope.recipient": email})
+    collection = message_collection(email['_folder'])
+    source = collection.find_one({'_id': email['_id']}, BODY_SOURCE_FIELDS) or {}
+    body = build_body(source, message_ref(email['_folder'], email['_id']))
+    collection.update_one({'_id': email['_id']}, {'$set': {'body': body}})
+    return body
+
+
+def user_entries(email_ids, projection=ENTRY_PROJECTION):
+    """The current user's mailbox entries of some emails, by email_id"""
+    keys = [entry_key(current_user.id, email_id) for email_id in email_ids]
+    return {entry['email_id']: entry for entry in entries_collection.find({'_id': {'$in': keys}}, projection)}
+
+
+def search_folder_filter(folder):
+    """
+    Restrict a search over emails to one of the user's folders (trash and read
+    state live in entries); None when the folder (the trash, for the inbox)
+    holds more than SEARCH_FOLDER_ID_LIMIT emails
+    """
+    listed = folder if folder in ('trash', 'unread') else 'trash'
+    email_ids = [entry['email_id'] for entry in entries_collection
+                 .find(folder_query(current_user.id, listed), {'email_id': 1})
+                 .limit(SEARCH_FOLDER_ID_LIMIT + 1)]
+    if len(email_ids) > SEARCH_FOLDER_ID_LIMIT:
+        return None
+    return {'_id': {'$in' if listed == folder else '$nin': email_ids}}
+
+
+def in_search_folder(entry, folder):
+    """Whether an email with this entry of the user (or None) belongs in a folder"""
+    if entry is None:
+        # Mail without entries (not yet backfilled) only shows in the inbox
+        return folder not in ('trash', 'unread')
+    flags = entry['flags']
+    if bool(flags.get('trashed')) != (folder == 'trash'):
+        return False
+    return folder != 'unread' or not flags.get('seen')
+
+
+def scan_search_folder(query, projection, sort, folder):
+    """
+    Search matches in a folder too large to inline: the first SEARCH_SCAN_LIMIT
+    matches are checked against the user's entries a batch at a time; returns
+    (emails, entries by email_id)
+    """
+    emails, entries, batch = [], {}, []
+    cursor = emails_collection.find(query, projection).sort(sort).limit(SEARCH_SCAN_LIMIT)
+    for email in cursor:
+        batch.append(email)
+        if len(batch) < SEARCH_SCAN_BATCH:
+            continue
+        emails.extend(filter_search_batch(batch, folder, entries))
+        batch = []
+    emails.extend(filter_search_batch(batch, folder, entries))
+    return emails, entries
+
+
+def filter_search_batch(emails, folder, entries):
+    """Emails of a batch that belong in the folder; their entries are added to entries"""
+    batch_entries = user_entries([email['_id'] for email in emails]) if emails else {}
+    entries.update(batch_entries)
+    return [email for email in emails if in_search_folder(batch_entries.get(email['_id']), folder)]
+
+
+def email_list_items(emails, unread):
+    """List items from emails (summary projection) and unread(email) -> bool"""
+    # Emails stored before summaries existed: build them from the source fields
+    missing_ids = [email['_id'] for email in emails if 'summary' not in email]
+    if missing_ids:
+        sources = {
+            source['_id']: source
+            for source in emails_collection.find({'_id': {'$in': missing_ids}}, SUMMARY_SOURCE_FIELDS)
+        }
+        for email in emails:
+            if 'summary' not in email:
+                email['summary'] = build_summary(sources.get(email['_id'], {}))
     
-    # Query for emails where recipient matches any of the emails
-    query = {"$or": email_queries}
-    return query
+    return [{
+        **email['summary'],
+        'id': str(email['_id']),
+        'date': email.get('received_at') or datetime.utcnow(),
+        'unread': unread(email)
+    } for email in emails]
+
+
+def entry_list_items(entries):
+    """List items for a page of mailbox entries, in the entries' order"""
+    emails = {
+        email['_id']: email
+        for email in emails_collection.find({'_id': {'$in': [entry['email_id'] for entry in entries]}},
+                                            EMAIL_LIST_PROJECTION)
+    }
+    seen = {entry['email_id']: entry['flags'].get('seen') for entry in entries}
+    return email_list_items([emails[entry['email_id']] for entry in entries if entry['email_id'] in emails],
+                            lambda email: not seen[email['_id']])
+
+
+@app.context_processor
+def inject_live_events():
+    """Whether pages open the /events stream"""
+    return {'live_events': LIVE_EVENTS}
+
+
+@app.context_processor
+def inject_unread_count():
+    """Unread badge for the sidebar"""
+    if not current_user.is_authenticated:
+        return {}
+    try:
+        return {'unread_count': get_inbox_counts()['unread']}
+    except Exception as e:
+        logger.error(f"Error reading unread counter: {str(e)}")
+        return {}
+
+def build_text_search(search_query):
+    """Full-text ($text) filter for the search box; addresses match as phrases"""
+    terms = []
+    for term in search_query.split():
+        # user@domain.com would otherwise match any of user/domain/com
+        if ('@' in term or '.' in term.strip('.')) and '"' not in term:
+            term = f'"{term}"'
+        terms.append(term)
+    return {'$text': {'$search': ' '.join(terms)}}
+
+
+def search_options(search_query, date_field, projection=None):
+    """Projection and sort for a listing: relevance first when searching, else newest first"""
+    if not search_query:
+        return projection, [(date_field, -1)]
+    projection = {**(projection or {}), 'score': {'$meta': 'textScore'}}
+    return projection, [('score', {'$meta': 'textScore'}), (date_field, -1), ('_id', -1)]
 
 
 @app.route('/')
@@ -127,10 +384,16 @@ def index():
     # Handle sent and drafts folders
     if folder == 'sent':
         query = {'user_id': current_user.id}
-        total_count = sent_emails_collection.count_documents(query)
+        if search_query:
+            query.update(build_text_search(search_query))
+        projection, sort = search_options(search_query, 'sent_at')
+        if search_query:
+            total_count = sent_emails_collection.count_documents(query)
+        else:
+            total_count = get_folder_total('sent', sent_emails_collection)
         emails = list(sent_emails_collection
-                      .find(query)
-                      .sort('sent_at', -1)
+                      .find(query, projection)
+                      .sort(sort)
                       .skip((page - 1) * per_page)
                       .limit(per_page))
         
@@ -138,13 +401,15 @@ def index():
         processed_emails = []
         for email in emails:
             processed_email = {
-                'id': str(email['_id']),
+                'id': message_ref('sent', email['_id']),
                 'subject': email.get('subject', '(No subject)'),
                 'from_name': current_user.email,
                 'from_email': current_user.email,
                 'to_email': email.get('to', ''),
                 'date': email.get('sent_at', datetime.utcnow()),
-                'has_attachments': False,
+                'has_attachments': bool(email.get('attachments')),
+                'status': email.get('status', STATUS_SENT),
+                'last_error': email.get('last_error'),
                 'unread': False,
                 'snippet': email.get('message', '')[:150] + '...' if email.get('message') else ''
             }
@@ -164,10 +429,16 @@ def index():
     
     elif folder == 'drafts':
         query = {'user_id': current_user.id}
-        total_count = draft_emails_collection.count_documents(query)
+        if search_query:
+            query.update(build_text_search(search_query))
+        projection, sort = search_options(search_query, 'updated_at')
+        if search_query:
+            total_count = draft_emails_collection.count_documents(query)
+        else:
+            total_count = get_folder_total('drafts', draft_emails_collection)
         emails = list(draft_emails_collection
-                      .find(query)
-                      .sort('updated_at', -1)
+                      .find(query, projection)
+                      .sort(sort)
                       .skip((page - 1) * per_page)
                       .limit(per_page))
         
@@ -175,7 +446,7 @@ def index():
         processed_emails = []
         for email in emails:
             processed_email = {
-                'id': str(email['_id']),
+                'id': message_ref('drafts', email['_id']),
                 'subject': email.get('subject', '(Borrador sin asunto)'),
                 'from_name': current_user.email,
                 'from_email': current_user.email,
@@ -199,99 +470,104 @@ def index():
                               search_query=search_query,
                               folder=folder)
     
-    # Handle inbox/all/unread folders (existing logic)
-    # Build base query
-    # Admin users see all emails when folder is 'all'
-    try:
-        # Build query based on user role and folder
-        if is_admin() and folder == 'all':
-            query = {}
-        else:
-            # Get user data including aliases
-            user_data = users_collection.find_one({'_id': ObjectId(current_user.id)})
-            aliases = user_data.get('aliases', []) if user_data else []
-            query = build_email_query(email_address, aliases)
+    # Threaded inbox: pages over the per-user thread rollups (searches use the flat list)
+    if folder == 'threads' and not search_query:
+        query = {'user_id': current_user.id, 'count': {'$gt': 0}}
+        total_count = get_counts(db, counter_key(current_user.id, 'threads'),
+                                 lambda: count_threads(db, current_user.id))['total']
+        threads = list(threads_collection
+                       .find(query)
+                       .sort('last_date', -1)
+                       .skip((page - 1) * per_page)
+                       .limit(per_page))
         
-        # Add folder filter (all/inbox/unread)
-        if folder == 'unread':
-            query['processed'] = False
-        # 'inbox' and 'all' show all emails
-        
-        # Add search filter if provided
-        if search_query:
-            if '$and' not in query:
-                query['$and'] = []
-            query['$and'].append({
-                "$or": [
-                    {"subject": {"$regex": search_query, "$options": "i"}},
-                    {"from.email": {"$regex": search_query, "$options": "i"}},
-                    {"text": {"$regex": search_query, "$options": "i"}},
-                    {"to.email": {"$regex": search_query, "$options": "i"}},
-                    {"envelope.recipient": {"$regex": search_query, "$options": "i"}}
-                ]
+        processed_emails = []
+        for thread in threads:
+            participants = thread.get('participants') or []
+            processed_emails.append({
+                'id': thread['thread_id'],
+                'url': url_for('view_thread', thread_id=thread['thread_id']),
+                'subject': thread.get('subject') or '(No subject)',
+                'from_name': ', '.join(participants[:3]) + (' …' if len(participants) > 3 else ''),
+                'from_email': '',
+                'to_email': current_user.email,
+                'date': thread.get('last_date') or datetime.utcnow(),
+                'count': thread.get('count', 0),
+                'unread': thread.get('unread', 0) > 0,
+                'snippet': thread.get('snippet', '')
             })
         
-        # Calculate skip value for pagination
-        skip = (page - 1) * per_page
+        total_pages = (total_count + per_page - 1) // per_page
         
-        # Fetch emails
-        total_count = emails_collection.count_documents(query)
-        emails = list(emails_collection
-                      .find(query)
-                      .sort('received_at', -1)
-                      .skip(skip)
-                      .limit(per_page))
+        return render_template('index.html',
+                              email_address=email_address,
+                              emails=processed_emails,
+                              page=page,
+                              per_page=per_page,
+                              total_pages=total_pages,
+                              total_count=total_count,
+                              search_query=search_query,
+                              folder=folder)
+    
+    # Inbox, unread and trash page over the user's mailbox entries; the admin
+    # "all" folder and searches query emails directly
+    try:
+        all_emails = is_admin() and folder == 'all'
+        skip = (page - 1) * per_page
         
-        # Process emails for display
-        processed_emails = []
-        for email in emails:
-            try:
-                # Get actual recipient from email's 'to' field
-                to_list = email.get('to', [])
-                if to_list and len(to_list) > 0:
-                    # Use first recipient in 'to' field
-                    first_recipient = to_list[0]
-                    if isinstance(first_recipient, dict):
-                        to_email = first_recipient.get('email', '')
-                    else:
-                        to_email = str(first_recipient)
-                else:
-                    # Fallback to envelope recipient if no 'to' field
-                    envelope = email.get('envelope', {})
-                    if isinstance(envelope, dict):
-                        to_email = envelope.get('recipient', '')
-                    else:
-                        to_email = ''
-                
-                # Get 'from' field safely
-                from_field = email.get('from', {})
-                if isinstance(from_field, dict):
-                    from_name = from_field.get('name', '')
-                    from_email_addr = from_field.get('email', '')
+        if all_emails or search_query:
+            query = {} if all_emails else get_user_email_query()
+            
+            # Full-text search (text index, ranked by relevance)
+            if search_query:
+                query.update(build_text_search(search_query))
+            projection, sort = search_options(search_query, 'received_at', EMAIL_LIST_PROJECTION)
+            
+            folder_filter = None if all_emails else search_folder_filter(folder)
+            if all_emails or folder_filter is not None:
+                query.update(folder_filter or {})
+                if search_query:
+                    total_count = emails_collection.count_documents(query)
                 else:
-                    from_name = ''
-                    from_email_addr = str(from_field) if from_field else ''
+                    total_count = get_inbox_counts(all_emails=True)['total']
                 
-                # Get date safely
-                date_field = email.get('received_at')
-                if date_field is None:
-                    date_field = datetime.utcnow()
-                
-                processed_email = {
-                    'id': str(email['_id']),
-                    'subject': email.get('subject', '(No subject)') or '(No subject)',
-                    'from_name': from_name,
-                    'from_email': from_email_addr,
-                    'to_email': to_email or 'No recipient',
-                    'date': date_field,
-                    'has_attachments': len(email.get('attachments', [])) > 0,
-                    'unread': not email.get('processed', True),
-                    'snippet': (email.get('text', '')[:150] + '...') if email.get('text') else ''
-                }
-                processed_emails.append(processed_email)
-            except Exception as e:
-                logger.error(f"Error processing email {email.get('_id')}: {str(e)}")
-                continue
+                # Fetch emails (summary only, never bodies or attachments)
+                emails = list(emails_collection
+                              .find(query, projection)
+                              .sort(sort)
+                              .skip(skip)
+                              .limit(per_page))
+                entries = None if all_emails else user_entries([email['_id'] for email in emails])
+            else:
+                # Folder too large to inline its ids: filter the top matches by entry
+                emails, entries = scan_search_folder(query, projection, sort, folder)
+                total_count = len(emails)
+                emails = emails[skip:skip + per_page]
+            
+            if all_emails:
+                # Shared flag: read by any of its recipients
+                processed_emails = email_list_items(emails, lambda email: not email.get('processed', True))
+            else:
+                processed_emails = email_list_items(emails, lambda email: not (
+                    entries[email['_id']]['flags'].get('seen') if email['_id'] in entries
+                    else email.get('processed', True)
+                ))
+        else:
+            query = folder_query(current_user.id, folder)
+            
+            # Totals come from the maintained counters; the trash still counts its entries
+            if folder == 'trash':
+                total_count = entries_collection.count_documents(query)
+            else:
+                counts = get_inbox_counts()
+                total_count = counts['unread'] if folder == 'unread' else counts['total']
+            
+            entries = list(entries_collection
+                           .find(query, {'email_id': 1, 'flags': 1})
+                           .sort('received_at', -1)
+                           .skip(skip)
+                           .limit(per_page))
+            processed_emails = entry_list_items(entries)
         
         # Calculate pagination info
         total_pages = (total_count + per_page - 1) // per_page
@@ -313,6 +589,24 @@ def index():
         return redirect(url_for('index', folder=folder))
 
 
+@app.route('/thread/<thread_id>')
+@login_required
+def view_thread(thread_id):
+    """Messages of a conversation in the user's mailbox, oldest first"""
+    entries = list(entries_collection
+                   .find({**folder_query(current_user.id, 'inbox'), 'thread_id': thread_id},
+                         {'email_id': 1, 'flags': 1})
+                   .sort('received_at', 1))
+    messages = entry_list_items(entries)
+    if not messages:
+        return render_template('error.html', message='Conversation not found'), 404
+    
+    return render_template('thread.html',
+                          email_address=get_user_email(),
+                          subject=messages[-1].get('subject') or '(No subject)',
+                          messages=messages)
+
+
 @app.route('/view/<email_id>')
 @login_required
 def view_email(email_id):
@@ -320,82 +614,56 @@ def view_email(email_id):
     email_address = get_user_email()
     
     try:
-        # Try to get email from different collections
-        email = (emails_collection.find_one({'_id': ObjectId(email_id)}) or
-                 sent_emails_collection.find_one({'_id': ObjectId(email_id)}) or
-                 draft_emails_collection.find_one({'_id': ObjectId(email_id)}))
+        # One lookup on the message's collection, restricted to what the user may see
+        email = find_message(email_id, MESSAGE_VIEW_PROJECTION)
         
         if not email:
             return render_template('error.html', 
                                   message='Email not found'), 404
         
-        # Verify access: admins can view any email, users can only view their own
-        if not is_admin():
-            # Check if it's a sent or draft email
-            if email in sent_emails_collection.find({'_id': ObjectId(email_id)}) or \
-               email in draft_emails_collection.find({'_id': ObjectId(email_id)}):
-                # Sent and draft emails must belong to current user
-                if email.get('user_id') != current_user.id:
-                    return render_template('error.html',
-                                          message='Access denied'), 403
-            else:
-                # Inbox emails: check if recipient matches user or aliases
-                user_data = users_collection.find_one({'_id': ObjectId(current_user.id)})
-                aliases = user_data.get('aliases', []) if user_data else []
-                query = build_email_query(email_address, aliases)
-                is_recipient = emails_collection.count_documents({
-                    '_id': ObjectId(email_id),
-                    "$or": query["$or"]
-                }) > 0
-                
-                if not is_recipient:
-                    return render_template('error.html',
-                                          message='Access denied'), 403
-        
-        # Mark as read (only for inbox emails)
-        if 'received_at' in email:
-            emails_collection.update_one(
-                {'_id': ObjectId(email_id)},
+        # Mark as read for the current user only (inbox emails)
+        if email['_folder'] == 'inbox':
+            entry = entries_collection.find_one_and_update(
+                {'_id': entry_key(current_user.id, email['_id']), 'flags.seen': False},
+                {'$set': {'flags.seen': True}},
+                projection=ENTRY_PROJECTION
+            )
+            if entry:
+                record_seen_change(db, [entry], -1)
+            # The shared flag only records that some recipient has read it
+            result = emails_collection.update_one(
+                {'_id': email['_id'], 'processed': False},
                 {'$set': {'processed': True}}
             )
+            if result.modified_count:
+                record_processed_change(db, -1)
+        
+        # Sanitized HTML (cid: images already pointing at /inline) and plain text
+        body = get_message_body(email)
         
         # Process email for display
         processed_email = {
-            'id': str(email['_id']),
+            'id': message_ref(email['_folder'], email['_id']),
             'subject': email.get('subject', '(No subject)'),
             'from_name': email.get('from', {}).get('name', '') if isinstance(email.get('from'), dict) else email.get('from', ''),
             'from_email': email.get('from', {}).get('email', '') if isinstance(email.get('from'), dict) else email.get('from', ''),
             'to': email.get('to', []),
             'envelope_recipient': email.get('envelope', {}).get('recipient', ''),
             'date': email.get('received_at', email.get('sent_at', email.get('updated_at', datetime.utcnow()))),
-            'text': email.get('text', ''),
-            'html': email.get('html', email.get('message', '')),
+            'text': body.get('text') or '',
+            'html': body.get('html') or '',
             'headers': email.get('headers', {}),
             'message_id': email.get('message-id', ''),
             'attachments': email.get('attachments', []),
             'inlines': email.get('inlines', []),
             'verdict': email.get('verdict', {}),
-            'is_draft': 'created_at' in email,
-            'is_sent': 'sent_at' in email
+            'is_draft': email['_folder'] == 'drafts',
+            'is_sent': email['_folder'] == 'sent',
+            'status': email.get('status', STATUS_SENT) if email['_folder'] == 'sent' else None,
+            'last_error': email.get('last_error'),
+            'failed_recipients': email.get('failed_recipients') or []
         }
         
-        # Replace inline images with data URIs in HTML to prevent ERR_UNKNOWN_URL_SCHEME
-        html_content = processed_email['html']
-        if html_content and processed_email['inlines']:
-            import re
-            inline_map = {inline.get('cid'): inline for inline in processed_email['inlines']}
-            
-            # Replace all cid: references with data URIs
-            def replace_cid(match):
-                cid = match.group(1)
-                if cid in inline_map:
-                    inline = inline_map[cid]
-                    return f'data:{inline["type"]};base64,{inline["content"]}'
-                return match.group(0)
-            
-            html_content = re.sub(r'cid:([^"\s\)]+)', replace_cid, html_content, flags=re.IGNORECASE)
-            processed_email['html'] = html_content
-        
         return render_template('view_email.html',
                               email_address=email_address,
                               email=processed_email)
@@ -414,54 +682,52 @@ def download_attachment(email_id, attachment_index):
         logger.info(f"=== DOWNLOAD ATTACHMENT START ===")
         logger.info(f"Downloading attachment {attachment_index} from email {email_id}")
         
-        # Get email from different collections
-        email = (emails_collection.find_one({'_id': ObjectId(email_id)}) or
-                 sent_emails_collection.find_one({'_id': ObjectId(email_id)}) or
-                 draft_emails_collection.find_one({'_id': ObjectId(email_id)}))
+        # Fetch only the requested attachment of a message the user may access
+        email = find_message(email_id, {'_id': 1, 'attachments': {'$slice': [attachment_index, 1]}})
         
         if not email:
             logger.error(f"Email {email_id} not found")
             return render_template('error.html', message='Email not found'), 404
         
-        # Get attachments list
+        # Get attachments list (at most the requested one)
         attachments = email.get('attachments', [])
         
-        if attachment_index >= len(attachments):
-            logger.error(f"Attachment index {attachment_index} out of range (total: {len(attachments)})")
+        if not attachments:
+            logger.error(f"Attachment index {attachment_index} out of range")
             return render_template('error.html', message='Attachment not found'), 404
         
         # Get the specific attachment
-        attachment = attachments[attachment_index]
-        attachment_name = attachment.get('name', 'attachment')
-        attachment_type = attachment.get('type', 'application/octet-stream')
-        attachment_content = attachment.get('content', '')
+        attachment = attachments[0]
         
-        logger.info(f"Attachment: name={attachment_name}, type={attachment_type}, content_length={len(attachment_content)}")
+        logger.info(f"Attachment: name={attachment.get('name')}, type={attachment.get('type')}, hash={attachment.get('hash')}")
         
-        # Decode base64 content
-        try:
-            file_content = base64.b64decode(attachment_content)
-            logger.info(f"Successfully decoded attachment, size: {len(file_content)} bytes")
-        except Exception as e:
-            logger.error(f"Error decoding base64: {str(e)}")
-            return render_template('error.html', message='Error decoding attachment'), 500
-        
-        # Send file
-        from io import BytesIO
-        file_buffer = BytesIO(file_content)
-        
-        return send_file(
-            file_buffer,
-            as_attachment=True,
-            download_name=attachment_name,
-            mimetype=attachment_type
-        )
+        # Stream content from the blob store (Range, ETag and If-None-Match aware)
+        return attachment_response(attachment, attachment_store, disposition='attachment')
         
     except Exception as e:
         logger.error(f"Error downloading attachment: {str(e)}", exc_info=True)
         return render_template('error.html', message=f'Error downloading attachment: {str(e)}'), 500
 
 
+@app.route('/inline/<email_id>/<path:cid>')
+@login_required
+def inline_image(email_id, cid):
+    """Serve an inline (cid:) image of an email with long-lived cache headers"""
+    try:
+        # Fetch only the matching inline of a message the user may access
+        email = find_message(email_id, {'_id': 1, 'inlines': {'$elemMatch': {'cid': cid}}})
+        inlines = email.get('inlines') if email else None
+        if not inlines:
+            return render_template('error.html', message='Inline image not found'), 404
+        
+        return attachment_response(inlines[0], attachment_store, disposition='inline',
+                                   cache_control=INLINE_CACHE_CONTROL)
+        
+    except Exception as e:
+        logger.error(f"Error serving inline image: {str(e)}", exc_info=True)
+        return render_template('error.html', message=f'Error loading inline image: {str(e)}'), 500
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Login page"""
@@ -525,6 +791,7 @@ def change_password():
                     {'_id': ObjectId(current_user.id)},
                     {'$set': {'password_hash': new_password_hash}}
                 )
+                user_cache.invalidate(current_user.id)
                 flash('Contraseña cambiada exitosamente', 'success')
                 return redirect(url_for('index'))
     
@@ -571,6 +838,7 @@ def admin_users():
                     'created_at': datetime.utcnow()
                 }
                 users_collection.insert_one(new_user)
+                user_cache.invalidate(str(new_user['_id']))
                 flash(f'Usuario {email} creado exitosamente', 'success')
         
         elif action == 'delete':
@@ -580,6 +848,7 @@ def admin_users():
                     flash('No puedes eliminar tu propio usuario', 'error')
                 else:
                     users_collection.delete_one({'_id': ObjectId(user_id)})
+                    user_cache.invalidate(user_id)
                     flash('Usuario eliminado exitosamente', 'success')
     
     users = list(users_collection.find())
@@ -645,6 +914,7 @@ def edit_user(user_id):
                 {'_id': ObjectId(user_id)},
                 {'$set': update_data}
             )
+            user_cache.invalidate(user_id)
             flash('Usuario actualizado exitosamente', 'success')
             return redirect(url_for('admin_users'))
         else:
@@ -672,21 +942,43 @@ def toggle_user_role(user_id):
         {'_id': ObjectId(user_id)},
         {'$set': {'role': new_role}}
     )
+    user_cache.invalidate(user_id)
     
     return jsonify({'success': True, 'new_role': new_role})
 
 @app.route('/compose')
 @login_required
 def compose():
-    """Display compose email form"""
-    return render_template('compose.html')
+    """Display compose email form (optionally editing an existing draft)"""
+    draft_ref = request.args.get('draft')
+    if not draft_ref:
+        return render_template('compose.html')
+    
+    try:
+        folder, draft_id = parse_message_ref(draft_ref)
+    except InvalidId:
+        folder = None
+    draft = None
+    if folder == 'drafts':
+        draft = draft_emails_collection.find_one(
+            {'_id': draft_id, 'user_id': current_user.id},
+            {field: 1 for field in DRAFT_FIELDS + ('updated_at',)}
+        )
+    if not draft:
+        flash('Borrador no encontrado', 'error')
+        return redirect(url_for('index', folder='drafts'))
+    
+    return render_template('compose.html',
+                          draft_id=message_ref('drafts', draft['_id']),
+                          draft_version=draft_version(draft['updated_at']),
+                          draft=draft)
 
 
 @app.route('/send-email', methods=['POST'])
 @login_required
 def send_email():
-    """Send email via SMTP"""
-    logger.info(f"Starting email send process for user {current_user.email}")
+    """Queue an email for delivery by the outbound worker"""
+    logger.info(f"Queueing email for user {current_user.email}")
     
     # Get form data
     to = request.form.get('to', '').strip()
@@ -702,100 +994,29 @@ def send_email():
         flash('Por favor completa los campos requeridos', 'error')
         return redirect(url_for('compose'))
     
-    # Get user SMTP credentials
-    logger.info("Fetching user SMTP credentials...")
-    user_data = users_collection.find_one({'_id': ObjectId(current_user.id)})
-    smtp_username = user_data.get('smtp_username') if user_data else None
-    smtp_password = user_data.get('smtp_password') if user_data else None
-    
-    logger.info(f"SMTP credentials found: username={smtp_username}, password={'set' if smtp_password else 'not set'}")
-    
-    if not smtp_username or not smtp_password:
+    # Fail early if the worker will not be able to log in
+    user_data = user_cache.get(current_user.id)
+    if not user_data or not user_data.get('smtp_username') or not user_data.get('smtp_password'):
         flash('No tienes configuradas las credenciales SMTP. Contacta al administrador.', 'error')
         return redirect(url_for('compose'))
     
-    # Get SMTP configuration from environment
-    smtp_server = os.getenv('SMTP_SERVER', 'smtp.improvmx.com')
-    smtp_port = int(os.getenv('SMTP_PORT', '587'))
-    smtp_sec_type = os.getenv('SMTP_SEC_TYPE', 'TLS')
-    
-    logger.info(f"SMTP config: {smtp_server}:{smtp_port}, security={smtp_sec_type}")
-    
     try:
-        # Create message
-        logger.info("Creating email message...")
-        msg = MIMEMultipart('mixed')
-        msg['Subject'] = subject
-        msg['From'] = current_user.email
-        msg['To'] = to
-        
-        if cc:
-            msg['Cc'] = cc
-        
-        # Attach HTML message
-        html_part = MIMEText(message, 'html')
-        msg.attach(html_part)
-        
-        # Handle file attachments
-        attachments = request.files.getlist('attachments')
-        logger.info(f"Found {len(attachments)} attachment(s)")
-        
-        for attachment in attachments:
+        # Store attachments in the blob store; the queued message keeps references
+        attachments = []
+        for attachment in request.files.getlist('attachments'):
             if attachment and attachment.filename:
-                try:
-                    # Get file info
-                    filename = attachment.filename
-                    content_type = attachment.content_type or 'application/octet-stream'
-                    file_data = attachment.read()
-                    
-                    logger.info(f"Processing attachment: {filename}, size: {len(file_data)}, type: {content_type}")
-                    
-                    # Create attachment part with correct MIME type
-                    main_type, sub_type = content_type.split('/', 1)
-                    part = MIMEBase(main_type, sub_type)
-                    part.set_payload(file_data)
-                    encoders.encode_base64(part)
-                    
-                    # Set Content-Disposition header with filename
-                    part.add_header(
-                        'Content-Disposition',
-                        f'attachment; filename="{filename}"'
-                    )
-                    
-                    msg.attach(part)
-                    logger.info(f"Successfully attached {filename}")
-                    
-                except Exception as e:
-                    logger.error(f"Error processing attachment {attachment.filename}: {str(e)}")
-                    continue
-        
-        logger.info("Connecting to SMTP server...")
-        # Connect to SMTP server with timeout
-        if smtp_sec_type.upper() == 'TLS':
-            server = smtplib.SMTP(smtp_server, smtp_port, timeout=300)
-            logger.info("Starting TLS...")
-            server.starttls()
-        else:
-            server = smtplib.SMTP_SSL(smtp_server, smtp_port, timeout=300)
-        
-        logger.info("Logging in to SMTP server...")
-        server.login(smtp_username, smtp_password)
-        
-        # Prepare recipients list
-        recipients = [to]
-        if cc:
-            recipients.extend([c.strip() for c in cc.split(',') if c.strip()])
-        if bcc:
-            recipients.extend([b.strip() for b in bcc.split(',') if b.strip()])
-        
-        logger.info(f"Sending email to {len(recipients)} recipients...")
-        # Send email
-        server.sendmail(current_user.email, recipients, msg.as_string())
-        
-        logger.info("Closing SMTP connection...")
-        server.quit()
-        
-        # Save to sent folder
+                # Copied in chunks; Werkzeug already spooled large uploads to disk
+                digest, size = attachment_store.put_stream(attachment.stream)
+                attachments.append({
+                    'hash': digest,
+                    'name': attachment.filename,
+                    'type': attachment.content_type or 'application/octet-stream',
+                    'size': size
+                })
+                logger.info(f"Stored attachment: {attachment.filename}, size: {size}")
+        
+        # Save to sent folder as queued; outbound_worker.py delivers it
+        now = datetime.utcnow()
         sent_email = {
             'user_id': current_user.id,
             'from': current_user.email,
@@ -804,48 +1025,136 @@ def send_email():
             'bcc': bcc,
             'subject': subject,
             'message': message,
-            'sent_at': datetime.utcnow()
+            'attachments': attachments,
+            'recipients': split_addresses(to) + split_addresses(cc) + split_addresses(bcc),
+            'sent_at': now,
+            **queue_state(now)
         }
         sent_emails_collection.insert_one(sent_email)
-        
-        flash('Correo enviado exitosamente', 'success')
+        record_folder_change(db, current_user.id, 'sent', 1)
+        
+        # The draft this message was composed from is no longer needed
+        draft_ref = request.form.get('draft_id', '').strip()
+        draft_oid = draft_ref[len(MESSAGE_ID_PREFIXES['drafts']):]
+        if draft_ref.startswith(MESSAGE_ID_PREFIXES['drafts']) and ObjectId.is_valid(draft_oid):
+            result = draft_emails_collection.delete_one({'_id': ObjectId(draft_oid), 'user_id': current_user.id})
+            if result.deleted_count:
+                record_folder_change(db, current_user.id, 'drafts', -1)
+        
+        logger.info(f"Email {sent_email['_id']} queued for {len(sent_email['recipients'])} recipient(s)")
+        flash('Correo en cola de envío', 'success')
         return redirect(url_for('index', folder='sent'))
         
     except Exception as e:
-        logger.error(f"Error sending email: {str(e)}")
+        logger.error(f"Error queueing email: {str(e)}")
         flash(f'Error al enviar correo: {str(e)}', 'error')
         return redirect(url_for('compose'))
 
 
+# Editable draft fields; autosave writes only the ones that changed
+DRAFT_FIELDS = ('to', 'cc', 'bcc', 'subject', 'message')
+
+
+class DraftConflict(Exception):
+    """The draft was changed elsewhere since the client last loaded or saved it"""
+    pass
+
+
+def draft_version(updated_at):
+    """Concurrency token of a draft: its updated_at as an ISO string"""
+    return updated_at.isoformat() if updated_at else ''
+
+
+def upsert_draft(draft_ref, fields, expected_version=None):
+    """
+    Create a draft, or $set the given fields on an existing one.
+    With expected_version the update only applies if updated_at still matches
+    (optimistic concurrency); raises DraftConflict otherwise and LookupError
+    when the draft does not exist. Returns (draft ref, new version).
+    """
+    now = datetime.utcnow()
+    # MongoDB keeps millisecond precision; truncate so the token round-trips
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    
+    if not draft_ref:
+        draft = {
+            'user_id': current_user.id,
+            'from': current_user.email,
+            **{field: fields.get(field, '') for field in DRAFT_FIELDS},
+            'created_at': now,
+            'updated_at': now
+        }
+        draft_emails_collection.insert_one(draft)
+        record_folder_change(db, current_user.id, 'drafts', 1)
+        return message_ref('drafts', draft['_id']), draft_version(now)
+    
+    folder, draft_id = parse_message_ref(draft_ref)
+    if folder != 'drafts':
+        raise LookupError(draft_ref)
+    
+    query = {'_id': draft_id, 'user_id': current_user.id}
+    if expected_version:
+        query['updated_at'] = datetime.fromisoformat(expected_version)
+    update = {'$set': {**fields, 'updated_at': now}}
+    if 'message' in fields:
+        # The processed body is rebuilt on the next view
+        update['$unset'] = {'body': ''}
+    
+    result = draft_emails_collection.update_one(query, update)
+    if not result.matched_count:
+        current = draft_emails_collection.find_one({'_id': draft_id, 'user_id': current_user.id}, {'updated_at': 1})
+        if current:
+            raise DraftConflict(draft_version(current.get('updated_at')))
+        raise LookupError(draft_ref)
+    return draft_ref, draft_version(now)
+
+
 @app.route('/save-draft', methods=['POST'])
 @login_required
 def save_draft():
-    """Save email as draft"""
-    # Get form data
-    to = request.form.get('to', '').strip()
-    cc = request.form.get('cc', '').strip()
-    bcc = request.form.get('bcc', '').strip()
-    subject = request.form.get('subject', '').strip()
-    message = request.form.get('message', '').strip()
+    """Save email as draft (creating it or updating the one being edited)"""
+    fields = {field: request.form.get(field, '').strip() for field in DRAFT_FIELDS}
     
-    # Save to drafts folder
-    draft_email = {
-        'user_id': current_user.id,
-        'from': current_user.email,
-        'to': to,
-        'cc': cc,
-        'bcc': bcc,
-        'subject': subject,
-        'message': message,
-        'created_at': datetime.utcnow(),
-        'updated_at': datetime.utcnow()
-    }
-    draft_emails_collection.insert_one(draft_email)
+    try:
+        upsert_draft(request.form.get('draft_id', '').strip(), fields, request.form.get('draft_version', '').strip())
+    except DraftConflict:
+        flash('El borrador fue modificado en otra ventana. Vuelve a abrirlo para ver la última versión.', 'error')
+        return redirect(url_for('index', folder='drafts'))
+    except (LookupError, ValueError, InvalidId):
+        flash('Borrador no encontrado', 'error')
+        return redirect(url_for('index', folder='drafts'))
     
     flash('Borrador guardado exitosamente', 'success')
     return redirect(url_for('index', folder='drafts'))
 
 
+@app.route('/autosave-draft', methods=['POST'])
+@login_required
+def autosave_draft():
+    """
+    Autosave from the compose page. JSON body: draft_id and version (empty
+    for a new draft) plus only the fields that changed since the last save.
+    """
+    data = request.get_json(silent=True) or {}
+    fields = {field: str(data[field]).strip() for field in DRAFT_FIELDS if field in data}
+    draft_ref = (data.get('draft_id') or '').strip()
+    
+    if draft_ref and not fields:
+        return jsonify({'draft_id': draft_ref, 'version': data.get('version', '')})
+    
+    try:
+        draft_ref, version = upsert_draft(draft_ref, fields, data.get('version'))
+    except DraftConflict as e:
+        return jsonify({'error': 'Draft was modified elsewhere', 'version': str(e)}), 409
+    except (LookupError, ValueError, InvalidId):
+        return jsonify({'error': 'Draft not found'}), 404
+    except Exception as e:
+        logger.error(f"Error autosaving draft: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({'draft_id': draft_ref, 'version': version})
+
+
 @app.route('/delete-email/<email_id>', methods=['POST'])
 @login_required
 def delete_email(email_id):
@@ -855,14 +1164,26 @@ def delete_email(email_id):
         logger.info(f"=== DELETE EMAIL START ===")
         logger.info(f"Deleting email {email_id} from folder {folder}")
         
-        # Try to delete from different collections
-        result = (emails_collection.delete_one({'_id': ObjectId(email_id)}) or
-                 sent_emails_collection.delete_one({'_id': ObjectId(email_id)}) or
-                 draft_emails_collection.delete_one({'_id': ObjectId(email_id)}))
+        # Delete from the message's collection (only if the user may access it)
+        # and keep the counters in step
+        try:
+            folder_name, message_id = parse_message_ref(email_id)
+        except InvalidId:
+            folder_name = None
+        deleted = None
+        if folder_name == 'inbox':
+            deleted = received_mail_action([message_id], 'delete') > 0
+        elif folder_name:
+            deleted = message_collection(folder_name).find_one_and_delete(
+                {'_id': message_id, **message_access_query(folder_name)},
+                COUNTER_PROJECTION
+            )
+            if deleted:
+                record_folder_change(db, deleted.get('user_id'), folder_name, -1)
         
-        logger.info(f"Delete result: deleted_count={result.deleted_count}")
+        logger.info(f"Delete result: deleted={deleted is not None}")
         
-        if result.deleted_count > 0:
+        if deleted:
             flash('Correo eliminado exitosamente', 'success')
         else:
             flash('Correo no encontrado', 'error')
@@ -876,6 +1197,145 @@ def delete_email(email_id):
         return redirect(url_for('index', folder=folder))
 
 
+def group_message_refs(refs):
+    """Group message IDs by folder (unprefixed IDs are received mail); invalid IDs are skipped"""
+    groups = {}
+    for ref in refs:
+        try:
+            folder, message_id = parse_message_ref(ref)
+        except InvalidId:
+            continue
+        groups.setdefault(folder, []).append(message_id)
+    return groups
+
+
+def received_mail_action(ids, action):
+    """
+    Apply an action to received mail through the current user's mailbox
+    entries. An admin acting on mail outside their own mailbox trashes,
+    restores or deletes it for every recipient and changes only the shared
+    processed flag when marking it read or unread. Emails left without any
+    entry are deleted. Returns how many emails changed.
+    """
+    emails = {
+        email['_id']: email
+        for email in emails_collection.find({'_id': {'$in': ids}, **message_access_query('inbox')},
+                                            COUNTER_PROJECTION)
+    }
+    if not emails:
+        return 0
+    own = user_entries(emails, {'email_id': 1})
+    others = [email_id for email_id in emails if email_id not in own] if is_admin() else []
+    
+    selector, update = BULK_ACTIONS[action]
+    scope = {'_id': {'$in': [entry['_id'] for entry in own.values()]}}
+    if others and action not in ('mark_read', 'mark_unread'):
+        scope = {'$or': [scope, {'email_id': {'$in': others}}]}
+    entries = list(entries_collection.find({**scope, **selector}, ENTRY_PROJECTION))
+    changed = {entry['email_id'] for entry in entries}
+    
+    if entries:
+        target = {'_id': {'$in': [entry['_id'] for entry in entries]}, **selector}
+        operation = DeleteMany(target) if update is None else UpdateMany(target, update)
+        entries_collection.bulk_write([operation], ordered=False)
+        if action in ('delete', 'trash'):
+            record_entries_removed(db, entries)
+        elif action == 'restore':
+            for entry in entries:
+                entry['flags']['trashed'] = False
+            record_entries_restored(db, entries, list(emails.values()))
+        else:
+            record_seen_change(db, entries, -1 if action == 'mark_read' else 1)
+    
+    if action == 'delete':
+        # Emails nobody has in their mailbox anymore
+        candidates = list(changed | set(others))
+        remaining = set(entries_collection.distinct('email_id', {'email_id': {'$in': candidates}}))
+        orphans = [email_id for email_id in candidates if email_id not in remaining]
+        if orphans:
+            result = emails_collection.bulk_write([DeleteMany({'_id': {'$in': orphans}})], ordered=False)
+            if result.deleted_count:
+                record_emails_deleted(db, [emails[email_id] for email_id in orphans])
+            changed.update(orphans)
+    elif action in ('mark_read', 'mark_unread'):
+        # Shared flag: read by any recipient; only an admin outside their mailbox clears it
+        processed = action == 'mark_read'
+        flagged = list(changed) + others if processed else others
+        flagged = [email_id for email_id in flagged if emails[email_id].get('processed', True) != processed]
+        if flagged:
+            result = emails_collection.bulk_write(
+                [UpdateMany({'_id': {'$in': flagged}, 'processed': not processed}, {'$set': {'processed': processed}})],
+                ordered=False
+            )
+            record_processed_change(db, -result.modified_count if processed else result.modified_count)
+            changed.update(email_id for email_id in flagged if email_id in others)
+    return len(changed)
+
+
+def bulk_message_action(refs, action):
+    """
+    Apply an action to many messages with one bulk_write per collection and
+    update the counters; returns how many messages changed
+    """
+    changed = 0
+    for folder, ids in group_message_refs(refs).items():
+        if folder == 'inbox':
+            changed += received_mail_action(ids, action)
+            continue
+        
+        # Sent mail and drafts have no read state or trash: trashing deletes them
+        if action not in ('delete', 'trash'):
+            continue
+        collection = message_collection(folder)
+        messages = list(collection.find({'_id': {'$in': ids}, **message_access_query(folder)}, {'user_id': 1}))
+        if not messages:
+            continue
+        result = collection.bulk_write(
+            [DeleteMany({'_id': {'$in': [message['_id'] for message in messages]}})], ordered=False
+        )
+        for user_id, count in Counter(message.get('user_id') for message in messages).items():
+            record_folder_change(db, user_id, folder, -count)
+        changed += result.deleted_count
+    return changed
+
+
+@app.route('/bulk-action', methods=['POST'])
+@login_required
+def bulk_action():
+    """
+    Apply an action (delete, trash, restore, mark_read, mark_unread) to a
+    list of message IDs. Accepts JSON {action, ids} or the list form
+    (ids=<id>&ids=<id>...&action=...), which redirects back to the folder.
+    """
+    data = request.get_json(silent=True)
+    if data is not None:
+        action, refs = data.get('action'), data.get('ids') or []
+    else:
+        action, refs = request.form.get('action'), request.form.getlist('ids')
+    folder = request.args.get('folder', 'inbox')
+    
+    if action not in BULK_ACTIONS or not isinstance(refs, list) or len(refs) > BULK_MAX_IDS:
+        if data is not None:
+            return jsonify({'error': f'action must be one of {", ".join(BULK_ACTIONS)} with at most {BULK_MAX_IDS} ids'}), 400
+        flash('Acción no válida', 'error')
+        return redirect(url_for('index', folder=folder))
+    
+    try:
+        changed = bulk_message_action([str(ref) for ref in refs], action)
+    except Exception as e:
+        logger.error(f"Error in bulk action {action}: {str(e)}", exc_info=True)
+        if data is not None:
+            return jsonify({'error': str(e)}), 500
+        flash(f'Error al procesar los correos: {str(e)}', 'error')
+        return redirect(url_for('index', folder=folder))
+    
+    logger.info(f"Bulk {action} by {current_user.email}: {changed} of {len(refs)} message(s)")
+    if data is not None:
+        return jsonify({'success': True, 'action': action, 'requested': len(refs), 'changed': changed})
+    flash(f'{changed} correo(s) actualizados', 'success')
+    return redirect(url_for('index', folder=folder))
+
+
 @app.route('/reply/<email_id>')
 @login_required
 def reply_email(email_id):
@@ -886,25 +1346,10 @@ def reply_email(email_id):
         logger.info(f"Reply to email {email_id} from folder {folder}")
         logger.info(f"Authenticated user: {current_user.email}")
         
-        # Try to get email from inbox
-        logger.info(f"Searching for email {email_id} in emails_collection...")
-        email = emails_collection.find_one({'_id': ObjectId(email_id)})
-        logger.info(f"Found in emails_collection: {email is not None}")
+        email = find_message(email_id, MESSAGE_REPLY_PROJECTION)
         
-        # If not in inbox, try sent
         if not email:
-            logger.info(f"Searching for email {email_id} in sent_emails_collection...")
-            email = sent_emails_collection.find_one({'_id': ObjectId(email_id)})
-            logger.info(f"Found in sent_emails_collection: {email is not None}")
-        
-        # If not in sent, try drafts
-        if not email:
-            logger.info(f"Searching for email {email_id} in draft_emails_collection...")
-            email = draft_emails_collection.find_one({'_id': ObjectId(email_id)})
-            logger.info(f"Found in draft_emails_collection: {email is not None}")
-        
-        if not email:
-            logger.error(f"Email {email_id} not found in any collection")
+            logger.error(f"Email {email_id} not found")
             flash('Correo no encontrado', 'error')
             return redirect(url_for('index', folder=folder))
         
@@ -962,9 +1407,7 @@ def reply_all_email(email_id):
     try:
         folder = request.args.get('folder', 'inbox')
         
-        # Get email from inbox or sent
-        email = (emails_collection.find_one({'_id': ObjectId(email_id)}) or
-                 sent_emails_collection.find_one({'_id': ObjectId(email_id)}))
+        email = find_message(email_id, MESSAGE_REPLY_PROJECTION)
         
         if not email:
             flash('Correo no encontrado', 'error')
@@ -1035,9 +1478,7 @@ def forward_email(email_id):
     try:
         folder = request.args.get('folder', 'inbox')
         
-        # Get email from inbox or sent
-        email = (emails_collection.find_one({'_id': ObjectId(email_id)}) or
-                 sent_emails_collection.find_one({'_id': ObjectId(email_id)}))
+        email = find_message(email_id, MESSAGE_REPLY_PROJECTION)
         
         if not email:
             flash('Correo no encontrado', 'error')
@@ -1088,16 +1529,48 @@ Para: {', '.join([r.get('email', '') if isinstance(r, dict) else str(r) for r in
         return redirect(url_for('index', folder=folder))
 
 
+@app.route('/events')
+@login_required
+def events():
+    """Server-Sent Events: new mail and inbox counter changes for the current user"""
+    # 204 tells EventSource not to reconnect (blocking workers or no change streams)
+    if not LIVE_EVENTS or not mail_events.available:
+        return '', 204
+    
+    user_data = user_cache.get(current_user.id)
+    addresses = [current_user.email] + (user_data.get('aliases', []) if user_data else [])
+    try:
+        initial = [('counters', get_inbox_counts())]
+    except Exception as e:
+        logger.error(f"Error reading counters for events: {str(e)}")
+        initial = []
+    
+    # Everything the stream needs is resolved here; it does not keep the request context
+    subscriber = mail_events.subscribe(current_user.id, addresses)
+    return Response(mail_events.stream(subscriber, initial),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
     try:
         # Test MongoDB connection
         client.server_info()
+        
+        # Outbound workers that reported recently (queue outcomes and SMTP pool stats)
+        recent = datetime.utcnow() - timedelta(minutes=5)
+        outbound_workers = [
+            {**worker, 'updated_at': worker['updated_at'].isoformat()}
+            for worker in db['worker_status'].find({'type': 'outbound', 'updated_at': {'$gte': recent}})
+        ]
         return jsonify({
             'status': 'healthy',
             'service': 'Webmail Application',
-            'timestamp': datetime.utcnow().isoformat()
+            'timestamp': datetime.utcnow().isoformat(),
+            'outbound_workers': outbound_workers,
+            'mail_events': mail_events.stats()
         }), 200
     except Exception as e:
         return jsonify({
@@ -1120,5 +1593,6 @@ if __name__ == '__main__':
     # Initialize default admin if no users exist
     initialize_default_admin()
     
-    # For development only
+    # For development only (threaded, so it serves /events)
+    LIVE_EVENTS = True
     app.run(host='0.0.0.0', port=26000, debug=True)
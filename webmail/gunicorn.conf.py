@@ -1,13 +1,19 @@
 # Gunicorn configuration file for Webmail Application
 import multiprocessing
+import os
 
 # Server socket
 bind = "0.0.0.0:26000"
 backlog = 2048
 
 # Worker processes
+# gevent workers keep the long-lived /events (Server-Sent Events) connections
+# without tying up a worker each. With any class but gevent or gthread the app
+# refuses /events and pages work without live updates
+EVENTS_WORKER_CLASSES = ("gevent", "gthread", "gunicorn.workers.ggevent.GeventWorker",
+                         "gunicorn.workers.gthread.ThreadWorker")
 workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
 worker_connections = 1000
 max_requests = 1000
 max_requests_jitter = 50
@@ -41,7 +47,12 @@ chdir = "/home/jose/webmail_improvmx/webmail"
 # Server hooks
 def on_starting(server):
     """Called just before the master process is initialized."""
-    pass
+    # Workers inherit it; the app decides from it whether to serve /events
+    worker_class = server.cfg.worker_class_str
+    os.environ["GUNICORN_WORKER_CLASS"] = worker_class
+    if worker_class not in EVENTS_WORKER_CLASSES:
+        server.log.warning("Worker class %s cannot hold /events connections open; "
+                           "live updates are disabled (use gevent or gthread)", worker_class)
 
 def on_reload(server):
     """Called to recycle workers during a reload via SIGHUP."""
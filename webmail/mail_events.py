@@ -0,0 +1,182 @@
+"""
+Live mailbox events for the webmail (Server-Sent Events)
+Each worker opens a single change stream on the database, filtered to newly
+received emails and inbox counter updates, and fans the events out to the
+browsers subscribed to /events: 'message' when mail routed to a subscriber
+arrives, 'counters' when the subscriber's inbox totals change.
+Browsers never poll MongoDB.
+
+Change streams need a replica set. Against a standalone server the hub marks
+itself unavailable and pages simply keep working without live updates. A
+single-node replica set is enough for local testing:
+
+    mongod --replSet rs0 --dbpath /tmp/rs0 --port 27017
+    mongosh --eval 'rs.initiate()'
+"""
+
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', '100'))  # Pending events per subscriber
+EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', '15'))  # Seconds between keep-alive comments
+EVENTS_RETRY_DELAY = 5  # Seconds before reopening a failed change stream
+
+# "$changeStream is only supported on replica sets" and similar
+UNSUPPORTED_CODES = {40573, 40324, 136}
+
+# Only new mail and counter changes; bodies and attachments never leave the server
+WATCH_PIPELINE = [
+    {'$match': {'$or': [
+        {'ns.coll': 'emails', 'operationType': 'insert'},
+        {'ns.coll': 'mailbox_counters', 'operationType': {'$in': ['insert', 'update', 'replace']}}
+    ]}},
+    {'$project': {
+        'ns': 1, 'operationType': 1, 'documentKey': 1,
+        'fullDocument.recipients': 1, 'fullDocument.user_ids': 1, 'fullDocument.summary': 1,
+        'fullDocument.received_at': 1,
+        'fullDocument.total': 1, 'fullDocument.unread': 1
+    }}
+]
+
+
+def format_event(name, data):
+    """One SSE frame"""
+    return f"event: {name}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class Subscriber:
+    """A connected browser: its user, mailbox addresses and pending events"""
+
+    def __init__(self, user_id, addresses):
+        self.user_id = str(user_id)
+        self.addresses = {address.strip().lower() for address in addresses if address}
+        self.queue = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+
+    def publish(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # A stalled client misses events; the next counters event resyncs it
+            pass
+
+
+class MailEventHub:
+    """One change stream per worker, fanned out to every subscriber"""
+
+    def __init__(self, db):
+        self.db = db
+        self.available = True
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, user_id, addresses):
+        subscriber = Subscriber(user_id, addresses)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            # The stream is opened by the first subscriber of this worker
+            if self._thread is None and self.available:
+                self._thread = threading.Thread(target=self._run, name='mail-events', daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stats(self):
+        with self._lock:
+            return {'available': self.available, 'subscribers': len(self._subscribers)}
+
+    def stream(self, subscriber, initial=()):
+        """SSE frames for a subscriber until the client disconnects"""
+        try:
+            for name, data in initial:
+                yield format_event(name, data)
+            while True:
+                if not self.available:
+                    yield format_event('unavailable', {})
+                    return
+                try:
+                    event = subscriber.queue.get(timeout=EVENTS_HEARTBEAT)
+                except queue.Empty:
+                    # Keeps proxies from closing an idle connection
+                    yield ': ping\n\n'
+                    continue
+                if event is None:
+                    continue
+                yield format_event(*event)
+        finally:
+            self.unsubscribe(subscriber)
+
+    def _run(self):
+        resume_token = None
+        while True:
+            try:
+                with self.db.watch(WATCH_PIPELINE, full_document='updateLookup',
+                                   resume_after=resume_token) as changes:
+                    logger.info("Mail event change stream opened")
+                    for change in changes:
+                        resume_token = changes.resume_token
+                        self._dispatch(change)
+            except OperationFailure as e:
+                if e.code in UNSUPPORTED_CODES:
+                    logger.warning(f"Change streams not supported, live mail events disabled: {str(e)}")
+                    self._disable()
+                    return
+                logger.error(f"Mail event change stream failed: {str(e)}")
+                # The resume point may have fallen off the oplog
+                resume_token = None
+            except PyMongoError as e:
+                logger.error(f"Mail event change stream interrupted: {str(e)}")
+            except Exception as e:
+                logger.error(f"Mail event change stream error: {str(e)}", exc_info=True)
+            time.sleep(EVENTS_RETRY_DELAY)
+
+    def _disable(self):
+        with self._lock:
+            self.available = False
+            subscribers = list(self._subscribers)
+        # Wake the streams so they can tell their clients
+        for subscriber in subscribers:
+            subscriber.publish(None)
+
+    def _dispatch(self, change):
+        document = change.get('fullDocument') or {}
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        if change['ns']['coll'] == 'emails':
+            recipients = set(document.get('recipients') or [])
+            summary = document.get('summary') or {}
+            event = ('message', {
+                'id': str(change['documentKey']['_id']),
+                'subject': summary.get('subject'),
+                'from_name': summary.get('from_name'),
+                'from_email': summary.get('from_email'),
+                'snippet': summary.get('snippet'),
+                'date': document.get('received_at')
+            })
+            if 'user_ids' in document:
+                user_ids = set(document['user_ids'])
+                targets = [subscriber for subscriber in subscribers if subscriber.user_id in user_ids]
+            else:
+                # Spooled before routing existed: match the subscriber's addresses
+                targets = [subscriber for subscriber in subscribers if subscriber.addresses & recipients]
+        else:
+            user_id, _, folder = str(change['documentKey']['_id']).partition(':')
+            if folder != 'inbox':
+                return
+            event = ('counters', {'total': max(0, document.get('total', 0)), 'unread': max(0, document.get('unread', 0))})
+            targets = [subscriber for subscriber in subscribers if subscriber.user_id == user_id]
+
+        for subscriber in targets:
+            subscriber.publish(event)
@@ -0,0 +1,97 @@
+"""
+Streaming MIME messages for the outbound worker
+Builds a multipart/mixed message as a generator of CRLF-terminated byte
+lines, base64-encoding attachments chunk by chunk straight from the blob
+store, so the whole message (or a whole attachment) is never held in memory.
+smtp_pool.SMTPPool.send_lines writes the lines to the SMTP DATA phase.
+"""
+
+import os
+import sys
+import base64
+import uuid
+from email.header import Header
+from email.utils import formatdate, encode_rfc2231
+
+# Shared modules live in the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from attachment_stream import open_attachment
+
+CRLF = b'\r\n'
+LINE_BYTES = 57  # Raw bytes per 76-character base64 line
+READ_BYTES = LINE_BYTES * 1024  # Raw bytes read from the store at a time
+
+
+def _header_value(value):
+    """ASCII header value, RFC 2047-encoded when needed"""
+    value = str(value or '')
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        return Header(value, 'utf-8').encode(linesep='\r\n')
+
+
+def _param(name, value):
+    """MIME parameter, RFC 2231-encoded for non-ASCII values"""
+    try:
+        value.encode('ascii')
+        return f'{name}="{value.replace(chr(34), "")}"'
+    except UnicodeEncodeError:
+        return f"{name}*={encode_rfc2231(value, 'utf-8')}"
+
+
+def _base64_lines(stream):
+    """Base64 lines (76 characters + CRLF) of a readable stream"""
+    while True:
+        chunk = stream.read(READ_BYTES)
+        if not chunk:
+            break
+        for offset in range(0, len(chunk), LINE_BYTES):
+            yield base64.b64encode(chunk[offset:offset + LINE_BYTES]) + CRLF
+
+
+def message_lines(message, store):
+    """Yield the MIME message of a queued sent_emails document, line by line"""
+    boundary = f'=_{uuid.uuid4().hex}'
+    # Stable across retries so receivers can drop duplicates
+    domain = message['from'].rsplit('@', 1)[-1].strip('> ')
+
+    headers = [
+        ('From', message['from']),
+        ('To', message.get('to', '')),
+        ('Cc', message.get('cc')),
+        ('Subject', message.get('subject', '')),
+        ('Date', formatdate(localtime=True)),
+        ('Message-ID', f"<{message['_id']}.outbound@{domain}>"),
+        ('MIME-Version', '1.0'),
+        ('Content-Type', f'multipart/mixed; boundary="{boundary}"'),
+    ]
+    for name, value in headers:
+        if value:
+            yield f'{name}: {_header_value(value)}'.encode('ascii') + CRLF
+    yield CRLF
+
+    # HTML body
+    yield f'--{boundary}'.encode('ascii') + CRLF
+    yield b'Content-Type: text/html; charset="utf-8"' + CRLF
+    yield b'Content-Transfer-Encoding: base64' + CRLF + CRLF
+    body = (message.get('message') or '').encode('utf-8')
+    for offset in range(0, len(body), LINE_BYTES):
+        yield base64.b64encode(body[offset:offset + LINE_BYTES]) + CRLF
+
+    # Attachments, streamed from the blob store
+    for attachment in message.get('attachments') or []:
+        name = attachment.get('name') or 'attachment'
+        yield f'--{boundary}'.encode('ascii') + CRLF
+        yield f"Content-Type: {attachment.get('type') or 'application/octet-stream'}; {_param('name', name)}".encode('ascii') + CRLF
+        yield f"Content-Disposition: attachment; {_param('filename', name)}".encode('ascii') + CRLF
+        yield b'Content-Transfer-Encoding: base64' + CRLF + CRLF
+        blob, _, _ = open_attachment(attachment, store)
+        try:
+            yield from _base64_lines(blob)
+        finally:
+            blob.close()
+
+    yield f'--{boundary}--'.encode('ascii') + CRLF
+
@@ -0,0 +1,290 @@
+"""
+Outbound mail queue and delivery worker
+/send-email only stores the message in sent_emails with status 'queued'
+(attachments go to the blob store) and returns. This worker, run as its own
+process, claims due messages, delivers them over SMTP and records the
+outcome on the document:
+
+    queued -> sending -> sent
+                      -> queued (temporary failure, retried with exponential backoff)
+                      -> failed (permanent failure or too many attempts)
+                      -> partial (delivered to some recipients, others failed for good)
+
+When only some recipients are refused, the accepted ones are recorded in
+delivered_recipients and the 5xx ones in failed_recipients, and the message
+is queued again for the 4xx ones alone (recipients is narrowed to them).
+
+A message left in 'sending' by a crashed worker is claimed again after
+OUTBOUND_SENDING_TIMEOUT seconds.
+
+Usage:
+    python outbound_worker.py
+"""
+
+import os
+import sys
+import time
+import socket
+import logging
+import smtplib
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from bson.objectid import ObjectId
+
+# Shared modules (attachment store, indexes, ...) live in the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from blob_store import get_blob_store
+from db_indexes import get_database
+
+from smtp_pool import SMTPPool
+from mime_stream import message_lines
+
+logger = logging.getLogger(__name__)
+
+# Queue configuration
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv('OUTBOUND_MAX_ATTEMPTS', '8'))
+OUTBOUND_RETRY_BASE = float(os.getenv('OUTBOUND_RETRY_BASE', '60'))  # Seconds before the first retry
+OUTBOUND_RETRY_MAX = float(os.getenv('OUTBOUND_RETRY_MAX', '3600'))  # Max seconds between retries
+OUTBOUND_POLL_INTERVAL = float(os.getenv('OUTBOUND_POLL_INTERVAL', '2'))  # Seconds between queue polls
+OUTBOUND_SENDING_TIMEOUT = float(os.getenv('OUTBOUND_SENDING_TIMEOUT', '600'))  # Reclaim stuck messages after
+
+# SMTP configuration
+SMTP_SERVER = os.getenv('SMTP_SERVER', 'smtp.improvmx.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
+SMTP_SEC_TYPE = os.getenv('SMTP_SEC_TYPE', 'TLS')
+
+STATS_INTERVAL = 30  # Seconds between worker stats reports
+
+STATUS_QUEUED = 'queued'
+STATUS_SENDING = 'sending'
+STATUS_SENT = 'sent'
+STATUS_FAILED = 'failed'
+STATUS_PARTIAL = 'partial'
+
+
+def is_permanent(smtp_code):
+    """5xx SMTP replies are permanent failures"""
+    return 500 <= smtp_code < 600
+
+
+class PermanentDeliveryError(Exception):
+    """Delivery failure that retrying cannot fix"""
+    pass
+
+
+def queue_state(now=None):
+    """Queue fields of a message that is ready to be sent"""
+    return {
+        'status': STATUS_QUEUED,
+        'attempts': 0,
+        'next_attempt_at': now or datetime.utcnow(),
+        'last_error': None
+    }
+
+
+def refusal_errors(refused):
+    """'address: code reply' lines for a {address: (code, reply)} dict of refused recipients"""
+    return [
+        f"{address}: {code} {reply.decode('utf-8', 'replace') if isinstance(reply, bytes) else reply}"
+        for address, (code, reply) in refused.items()
+    ]
+
+
+def split_addresses(value):
+    """Comma separated address field as a list"""
+    return [address.strip() for address in (value or '').split(',') if address.strip()]
+
+
+def retry_delay(attempts):
+    """Exponential backoff: base, 2*base, 4*base, ... capped at OUTBOUND_RETRY_MAX"""
+    return min(OUTBOUND_RETRY_BASE * (2 ** max(0, attempts - 1)), OUTBOUND_RETRY_MAX)
+
+
+class OutboundWorker:
+    """Claims queued messages from sent_emails and delivers them"""
+
+    def __init__(self, db, store=None, pool=None):
+        self.sent_emails = db['sent_emails']
+        self.users = db['users']
+        self.worker_status = db['worker_status']
+        self.store = store or get_blob_store(db)
+        self.pool = pool or SMTPPool()
+        self.worker_id = f"outbound:{socket.gethostname()}:{os.getpid()}"
+        self.outcomes = {STATUS_SENT: 0, STATUS_QUEUED: 0, STATUS_FAILED: 0, STATUS_PARTIAL: 0}
+        self._stats_reported_at = 0
+
+    def claim(self):
+        """Atomically take the next due message (or a stuck one); None when idle"""
+        now = datetime.utcnow()
+        return self.sent_emails.find_one_and_update(
+            {'$or': [
+                {'status': STATUS_QUEUED, 'next_attempt_at': {'$lte': now}},
+                {'status': STATUS_SENDING, 'locked_at': {'$lte': now - timedelta(seconds=OUTBOUND_SENDING_TIMEOUT)}}
+            ]},
+            {'$set': {'status': STATUS_SENDING, 'locked_at': now}, '$inc': {'attempts': 1}},
+            sort=[('next_attempt_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def deliver(self, message):
+        """
+        Send one message with its owner's SMTP credentials; returns the
+        recipients the server refused, {address: (code, reply)}
+        """
+        user = self.users.find_one({'_id': ObjectId(message['user_id'])}, {'smtp_username': 1, 'smtp_password': 1})
+        if not user or not user.get('smtp_username') or not user.get('smtp_password'):
+            raise PermanentDeliveryError('No SMTP credentials configured for this user')
+
+        recipients = message.get('recipients') or split_addresses(message.get('to'))
+
+        try:
+            # Pooled, already authenticated session for this account; the MIME
+            # message is generated line by line while it is written to the socket
+            return self.pool.send_lines(
+                SMTP_SERVER, SMTP_PORT, SMTP_SEC_TYPE,
+                user['smtp_username'], user['smtp_password'],
+                message['from'], recipients, lambda: message_lines(message, self.store)
+            )
+        except smtplib.SMTPRecipientsRefused as e:
+            # Every recipient refused: permanent when all got a 5xx (greylisting
+            # answers 450/451), else handled like a partial refusal
+            if all(is_permanent(code) for code, _ in e.recipients.values()):
+                raise PermanentDeliveryError('; '.join(refusal_errors(e.recipients)))
+            return e.recipients
+        except smtplib.SMTPResponseException as e:
+            # Includes refused senders and failed logins: 5xx replies are
+            # permanent, 4xx (421, 454, ...) are worth retrying
+            if is_permanent(e.smtp_code):
+                raise PermanentDeliveryError(str(e))
+            raise
+
+    def process(self, message):
+        """Deliver a claimed message and record the outcome"""
+        now = datetime.utcnow()
+        recipients = message.get('recipients') or split_addresses(message.get('to'))
+        try:
+            refused = self.deliver(message) or {}
+        except PermanentDeliveryError as e:
+            logger.error(f"Message {message['_id']} failed permanently: {str(e)}")
+            return self._fail(message, [str(e)], now)
+        except Exception as e:
+            return self._retry(message, recipients, [str(e)], now)
+
+        delivered = [address for address in recipients if address not in refused]
+        message = {**message, 'delivered_recipients': (message.get('delivered_recipients') or []) + delivered}
+        if not refused:
+            logger.info(f"Message {message['_id']} sent to {len(delivered)} recipient(s)")
+            if message.get('failed_recipients'):
+                # Recipients refused in earlier attempts stay failed
+                return self._fail(message, [], now)
+            self._finish(message, {
+                **self._progress(message),
+                'status': STATUS_SENT,
+                'last_error': None,
+                'sent_at': now
+            })
+            return STATUS_SENT
+
+        # Some recipients refused: 5xx ones failed for good, 4xx ones are retried alone
+        logger.warning(f"Message {message['_id']} refused for {len(refused)} of {len(recipients)} recipient(s)")
+        permanent = {address: reply for address, reply in refused.items() if is_permanent(reply[0])}
+        temporary = {address: reply for address, reply in refused.items() if address not in permanent}
+        message = {**message, 'failed_recipients': (message.get('failed_recipients') or []) + refusal_errors(permanent)}
+        if temporary:
+            return self._retry(message, list(temporary), refusal_errors(temporary), now)
+        return self._fail(message, [], now)
+
+    def _retry(self, message, recipients, errors, now):
+        """Queue the message again for recipients, or give up after too many attempts"""
+        attempts = message.get('attempts', 1)
+        if attempts >= OUTBOUND_MAX_ATTEMPTS:
+            logger.error(f"Message {message['_id']} failed after {attempts} attempt(s): {'; '.join(errors)}")
+            return self._fail(message, errors, now)
+        delay = retry_delay(attempts)
+        logger.warning(f"Message {message['_id']} attempt {attempts} failed, retrying in {delay}s: {'; '.join(errors)}")
+        self._finish(message, {
+            **self._progress(message),
+            'status': STATUS_QUEUED,
+            'recipients': recipients,
+            'last_error': '; '.join((message.get('failed_recipients') or []) + errors),
+            'next_attempt_at': now + timedelta(seconds=delay)
+        })
+        return STATUS_QUEUED
+
+    def _fail(self, message, errors, now):
+        """Give up: 'partial' when some recipient already got the message, else 'failed'"""
+        message = {**message, 'failed_recipients': (message.get('failed_recipients') or []) + errors}
+        status = STATUS_PARTIAL if message.get('delivered_recipients') else STATUS_FAILED
+        self._finish(message, {
+            **self._progress(message),
+            'status': status,
+            'last_error': '; '.join(message['failed_recipients']),
+            'failed_at': now
+        })
+        return status
+
+    @staticmethod
+    def _progress(message):
+        """Per-recipient outcomes carried over between attempts"""
+        return {
+            'delivered_recipients': message.get('delivered_recipients') or [],
+            'failed_recipients': message.get('failed_recipients') or []
+        }
+
+    def _finish(self, message, fields):
+        # Only the worker holding the claim may record the outcome
+        self.sent_emails.update_one(
+            {'_id': message['_id'], 'status': STATUS_SENDING, 'locked_at': message['locked_at']},
+            {'$set': fields, '$unset': {'locked_at': ''}}
+        )
+
+    def run_once(self):
+        """Process every due message; returns how many were processed"""
+        processed = 0
+        while True:
+            message = self.claim()
+            if not message:
+                return processed
+            self.outcomes[self.process(message)] += 1
+            processed += 1
+
+    def report_stats(self, force=False):
+        """Publish outcome counts and SMTP pool stats (shown by the webmail /health)"""
+        now = time.monotonic()
+        if not force and now - self._stats_reported_at < STATS_INTERVAL:
+            return
+        self._stats_reported_at = now
+        try:
+            self.worker_status.update_one(
+                {'_id': self.worker_id},
+                {'$set': {
+                    'type': 'outbound',
+                    'updated_at': datetime.utcnow(),
+                    'outcomes': self.outcomes,
+                    'smtp_pool': self.pool.stats()
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error reporting outbound worker stats: {str(e)}")
+
+    def run(self):
+        logger.info(f"Outbound worker started (SMTP {SMTP_SERVER}:{SMTP_PORT}, {SMTP_SEC_TYPE})")
+        while True:
+            try:
+                processed = self.run_once()
+                self.report_stats()
+                if not processed:
+                    time.sleep(OUTBOUND_POLL_INTERVAL)
+            except Exception as e:
+                logger.error(f"Outbound worker error: {str(e)}", exc_info=True)
+                time.sleep(OUTBOUND_POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    try:
+        OutboundWorker(get_database()).run()
+    except KeyboardInterrupt:
+        logger.info("Outbound worker stopped")
@@ -0,0 +1,301 @@
+"""
+Pool of authenticated SMTP sessions
+Keeps logged-in connections keyed by (server, port, username) so bursts of
+mail from the same account skip the TCP connect, TLS handshake and AUTH.
+Idle sessions are closed after SMTP_POOL_IDLE_TIMEOUT, sessions idle for a
+while are checked with NOOP before reuse, and a send that fails because a
+reused session was dropped by the server is retried once on a fresh one.
+A refused sender, recipient or message leaves the session in the pool; it is
+only closed on disconnects, 421 replies and other errors.
+
+For local testing, SMTP_SEC_TYPE=NONE connects in plain text and skips AUTH
+(e.g. against `python -m aiosmtpd -n -l localhost:8025`).
+"""
+
+import os
+import time
+import smtplib
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SMTP_POOL_MAX_PER_KEY = int(os.getenv('SMTP_POOL_MAX_PER_KEY', '2'))  # Sessions per account
+SMTP_POOL_MAX_TOTAL = int(os.getenv('SMTP_POOL_MAX_TOTAL', '20'))  # Sessions per process
+SMTP_POOL_IDLE_TIMEOUT = float(os.getenv('SMTP_POOL_IDLE_TIMEOUT', '60'))  # Close sessions idle this long
+SMTP_POOL_NOOP_AFTER = float(os.getenv('SMTP_POOL_NOOP_AFTER', '10'))  # NOOP-check sessions idle this long
+SMTP_POOL_ACQUIRE_TIMEOUT = 30  # Seconds to wait for a free session
+SMTP_TIMEOUT = 60
+SMTP_SEND_BUFFER = 64 * 1024  # Bytes written to the socket at a time when streaming
+
+
+class SMTPPoolExhausted(Exception):
+    """No session became available within the acquire timeout"""
+    pass
+
+
+class _Session:
+    def __init__(self, key, server):
+        self.key = key
+        self.server = server
+        self.last_used = time.monotonic()
+        self.uses = 0
+
+
+class SMTPPool:
+    """Bounded pool of authenticated smtplib sessions"""
+
+    def __init__(self, max_per_key=SMTP_POOL_MAX_PER_KEY, max_total=SMTP_POOL_MAX_TOTAL,
+                 idle_timeout=SMTP_POOL_IDLE_TIMEOUT, noop_after=SMTP_POOL_NOOP_AFTER,
+                 acquire_timeout=SMTP_POOL_ACQUIRE_TIMEOUT):
+        self.max_per_key = max_per_key
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.noop_after = noop_after
+        self.acquire_timeout = acquire_timeout
+        self._idle = {}  # key -> [_Session], most recently used last
+        self._open = {}  # key -> number of open sessions (idle + in use)
+        self._cond = threading.Condition()
+        self._stats = {'created': 0, 'reused': 0, 'closed': 0, 'noop_failures': 0, 'reconnects': 0}
+
+    # Public API
+
+    def sendmail(self, host, port, sec_type, username, password, from_addr, to_addrs, msg):
+        """Send through a pooled session, reconnecting once if a reused session was dropped"""
+        return self._send(host, port, sec_type, username, password,
+                          lambda server: server.sendmail(from_addr, to_addrs, msg))
+
+    def send_lines(self, host, port, sec_type, username, password, from_addr, to_addrs, lines_factory):
+        """
+        Like sendmail, but the message is streamed: lines_factory() returns an
+        iterable of CRLF-terminated byte lines (called again if the send is retried)
+        """
+        return self._send(host, port, sec_type, username, password,
+                          lambda server: _send_lines(server, from_addr, to_addrs, lines_factory()))
+
+    def _send(self, host, port, sec_type, username, password, send):
+        for attempt in range(2):
+            reused = False
+            try:
+                with self.connection(host, port, sec_type, username, password) as session:
+                    reused = session.uses > 0
+                    return send(session.server)
+            except smtplib.SMTPServerDisconnected:
+                # The dropped session has been discarded; retry once on a new one
+                if not reused or attempt:
+                    raise
+                with self._cond:
+                    self._stats['reconnects'] += 1
+                logger.info(f"Pooled SMTP session for {username} was dropped, reconnecting")
+
+    @contextmanager
+    def connection(self, host, port, sec_type, username, password):
+        """
+        Borrow an authenticated session; it returns to the pool on success or
+        after a refusal it survives, and is closed on any other error
+        """
+        key = (host, port, username)
+        session = self._acquire(key, sec_type, password)
+        try:
+            yield session
+        except Exception as e:
+            if _survives(e, session.server):
+                self._release(session)
+            else:
+                self._discard(session)
+            raise
+        else:
+            self._release(session)
+
+    def stats(self):
+        with self._cond:
+            return {
+                **self._stats,
+                'open': sum(self._open.values()),
+                'idle': sum(len(sessions) for sessions in self._idle.values()),
+                'accounts': len([key for key, count in self._open.items() if count])
+            }
+
+    def close_all(self):
+        with self._cond:
+            sessions = [session for idle in self._idle.values() for session in idle]
+            self._idle.clear()
+        for session in sessions:
+            self._discard(session)
+
+    # Internals
+
+    def _acquire(self, key, sec_type, password):
+        deadline = time.monotonic() + self.acquire_timeout
+        self._close_expired()
+        while True:
+            with self._cond:
+                idle = self._idle.get(key)
+                session = idle.pop() if idle else None
+                evicted = None
+                if session is None and self._open.get(key, 0) < self.max_per_key:
+                    if sum(self._open.values()) < self.max_total:
+                        # Reserve a slot, then connect outside the lock
+                        self._open[key] = self._open.get(key, 0) + 1
+                        break
+                    # Pool full: make room by closing another account's oldest idle session
+                    candidates = [idle[0] for idle in self._idle.values() if idle]
+                    if candidates:
+                        evicted = min(candidates, key=lambda candidate: candidate.last_used)
+                        self._idle[evicted.key].remove(evicted)
+                if evicted is not None:
+                    self._discard(evicted)
+                    continue
+                if session is None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise SMTPPoolExhausted(f"No SMTP session available for {key[2]}")
+                    self._cond.wait(timeout=remaining)
+                    continue
+
+            if self._healthy(session):
+                with self._cond:
+                    self._stats['reused'] += 1
+                return session
+            self._discard(session)
+
+        try:
+            server = self._connect(key, sec_type, password)
+        except Exception:
+            with self._cond:
+                self._open[key] -= 1
+                self._cond.notify_all()
+            raise
+        session = _Session(key, server)
+        with self._cond:
+            self._stats['created'] += 1
+        return session
+
+    def _connect(self, key, sec_type, password):
+        host, port, username = key
+        if sec_type.upper() == 'TLS':
+            server = smtplib.SMTP(host, port, timeout=SMTP_TIMEOUT)
+            server.starttls()
+        elif sec_type.upper() == 'NONE':
+            server = smtplib.SMTP(host, port, timeout=SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP_SSL(host, port, timeout=SMTP_TIMEOUT)
+        try:
+            if sec_type.upper() != 'NONE':
+                server.login(username, password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _healthy(self, session):
+        """Sessions idle for a while must answer NOOP before reuse"""
+        if time.monotonic() - session.last_used < self.noop_after:
+            return True
+        try:
+            if session.server.noop()[0] == 250:
+                return True
+        except (smtplib.SMTPException, OSError):
+            pass
+        with self._cond:
+            self._stats['noop_failures'] += 1
+        return False
+
+    def _release(self, session):
+        session.last_used = time.monotonic()
+        session.uses += 1
+        with self._cond:
+            self._idle.setdefault(session.key, []).append(session)
+            self._cond.notify_all()
+
+    def _discard(self, session):
+        try:
+            session.server.quit()
+        except Exception:
+            session.server.close()
+        with self._cond:
+            self._open[session.key] = max(0, self._open.get(session.key, 0) - 1)
+            self._stats['closed'] += 1
+            self._cond.notify_all()
+
+    def _close_expired(self):
+        """Close sessions that sat idle longer than the idle timeout"""
+        now = time.monotonic()
+        expired = []
+        with self._cond:
+            for key, sessions in self._idle.items():
+                keep = [session for session in sessions if now - session.last_used < self.idle_timeout]
+                expired.extend(session for session in sessions if session not in keep)
+                self._idle[key] = keep
+        for session in expired:
+            self._discard(session)
+
+
+def _survives(error, server):
+    """
+    Refused senders, recipients or data are answered with RSET by _send_lines,
+    so the authenticated session stays usable unless the server closed it (421)
+    """
+    if getattr(server, 'sock', None) is None:
+        return False
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code != 421 for code, _ in error.recipients.values())
+    if isinstance(error, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)):
+        return error.smtp_code != 421
+    return False
+
+
+def _send_lines(server, from_addr, to_addrs, lines):
+    """
+    smtplib.SMTP.sendmail for a message given as an iterable of CRLF-terminated
+    byte lines; the DATA phase is written to the socket SMTP_SEND_BUFFER bytes at a time
+    """
+    server.ehlo_or_helo_if_needed()
+    code, response = server.mail(from_addr)
+    if code != 250:
+        if code == 421:
+            server.close()
+        else:
+            server._rset()
+        raise smtplib.SMTPSenderRefused(code, response, from_addr)
+
+    refused = {}
+    for address in to_addrs:
+        code, response = server.rcpt(address)
+        if code not in (250, 251):
+            refused[address] = (code, response)
+        if code == 421:
+            server.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(to_addrs):
+        server._rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, response = server.docmd('data')
+    if code != 354:
+        server._rset()
+        raise smtplib.SMTPDataError(code, response)
+
+    buffer = []
+    buffered = 0
+    for line in lines:
+        # Dot-stuffing (RFC 5321 4.5.2)
+        if line.startswith(b'.'):
+            line = b'.' + line
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= SMTP_SEND_BUFFER:
+            server.send(b''.join(buffer))
+            buffer, buffered = [], 0
+    buffer.append(b'.\r\n')
+    server.send(b''.join(buffer))
+
+    code, response = server.getreply()
+    if code != 250:
+        if code == 421:
+            server.close()
+        else:
+            server._rset()
+        raise smtplib.SMTPDataError(code, response)
+    return refused
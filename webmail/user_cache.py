@@ -0,0 +1,97 @@
+"""
+Per-worker cache of user records (profile, role, aliases, SMTP credentials)
+Avoids reading the same user document from MongoDB several times per page
+view. Entries expire after a TTL and are evicted LRU-first. Changes made by
+any worker bump a version stamp in MongoDB; every worker checks the stamp at
+most once per interval and drops its cache when it has moved.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1000'))  # Max cached users per worker
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))  # Seconds a record stays cached
+USER_CACHE_VERSION_INTERVAL = float(os.getenv('USER_CACHE_VERSION_INTERVAL', '2'))  # Seconds between stamp checks
+
+VERSION_KEY = 'users'
+
+
+class UserCache:
+    """LRU/TTL cache of user documents with cross-worker invalidation"""
+
+    def __init__(self, collection, versions, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL,
+                 version_interval=USER_CACHE_VERSION_INTERVAL):
+        self.collection = collection
+        self.versions = versions
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version_interval = version_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = 0
+
+    def get(self, user_id):
+        """Return the user document (do not modify it) or None"""
+        user_id = str(user_id)
+        self._check_version()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        user = self.collection.find_one({'_id': ObjectId(user_id)})
+        if user is not None:
+            with self._lock:
+                self._entries[user_id] = (now + self.ttl, user)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id=None):
+        """Drop a user (or everything) here and tell the other workers to do the same"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(str(user_id), None)
+        try:
+            document = self.versions.find_one_and_update(
+                {'_id': VERSION_KEY},
+                {'$inc': {'version': 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            with self._lock:
+                # Our own bump does not need to clear this worker's cache again
+                if self._version is not None and document['version'] == self._version + 1:
+                    self._version = document['version']
+        except Exception as e:
+            logger.error(f"Error bumping user cache version: {str(e)}")
+
+    def _check_version(self):
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_interval:
+            return
+        self._version_checked_at = now
+        try:
+            document = self.versions.find_one({'_id': VERSION_KEY})
+        except Exception as e:
+            logger.error(f"Error reading user cache version: {str(e)}")
+            return
+        version = document.get('version', 0) if document else 0
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version